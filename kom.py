@@ -0,0 +1,1373 @@
+# Copyright (c) 2009-2012 AJ
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Core KOM archive library shared by kom_packer.py, kom_unpacker.py and the
+other KOM tools.
+
+An archive is a 60-byte header ("KOG GC TEAM MASSFILE V.0.2." padded to 52
+bytes, the entry count and a flag), a table of 72-byte '<60s3I' rows (name,
+uncompressed size, compressed size and offset relative to the end of the
+table) and the entry data. Entries are zlib streams, or stored as is when both
+sizes are equal. A crc.xml entry lists the CRC32 of every compressed entry.
+
+Archives can be read from a path or from any bytes-like object, so batch jobs
+can work on many archives in the same process.
+"""
+
+import collections
+import fnmatch
+import hashlib
+import io
+import mmap
+import ntpath
+import os
+import re
+import shutil
+import struct
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from xml.etree.ElementTree import ParseError, XMLPullParser
+
+
+CHUNK_SIZE = 64 * 1024
+
+HEADER = b"KOG GC TEAM MASSFILE V.0.2."
+
+STRATEGIES = {
+    'default': zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'huffman': zlib.Z_HUFFMAN_ONLY,
+}
+
+STORE = None
+
+ACTIONS = ('pack', 'unpack', 'verify')
+
+DEFAULT_POLICY = (zlib.Z_DEFAULT_COMPRESSION, zlib.Z_DEFAULT_STRATEGY)
+
+
+# file names are plain bytes here, so an entry name can be written with its
+# own bytes whatever they are; Windows and macOS only take valid Unicode
+BYTES_FILE_NAMES = os.name == 'posix' and sys.platform != 'darwin'
+
+
+# entry names are raw bytes in the table. they are mapped to str as UTF-8 with
+# the bytes that are not UTF-8 (CP949 or Latin-1 names of older archives) kept
+# as lone surrogates, so a name gives the same str on every platform and goes
+# back to the same bytes
+def encode_name(name):
+    return name.encode('utf-8', 'surrogateescape')
+
+
+def decode_name(name):
+    return name.decode('utf-8', 'surrogateescape')
+
+
+def check_entry_name(name):
+    # entries are extracted right into the folder, so a name that is a path
+    # (absolute, with a drive, with separators or . and ..) could put the file
+    # anywhere and is refused
+    if name in ('', '.', '..') or '/' in name or '\\' in name or ntpath.splitdrive(name)[0] != '':
+        raise ValueError('entry name %r is not a plain file name' % name)
+
+
+def get_file_name(folder_name, name):
+    # the path an entry is extracted to; a name that is not UTF-8 is written
+    # with its raw bytes where file names are bytes, and is refused elsewhere
+    # rather than being written under some other name
+    check_entry_name(name)
+
+    try:
+        name.encode('utf-8')
+
+        return os.path.join(folder_name, name)
+    except UnicodeEncodeError:
+        pass
+
+    if not BYTES_FILE_NAMES:
+        raise ValueError('entry name %r is not UTF-8 and cannot be a file name on this system' % name)
+
+    return os.path.join(os.fsencode(folder_name), encode_name(name))
+
+
+class Entry(object):
+    def __init__(self, name, uncompressed_size, compressed_size, relative_offset):
+        self.__name = decode_name(name.split(b'\0', 1)[0])
+        self.__uncompressed_size = uncompressed_size
+        self.__compressed_size = compressed_size
+        self.__relative_offset = relative_offset
+
+    def get_name(self):
+        return self.__name
+
+    def get_uncompressed_size(self):
+        return self.__uncompressed_size
+
+    def get_compressed_size(self):
+        return self.__compressed_size
+
+    def get_relative_offset(self):
+        return self.__relative_offset
+
+    name = property(get_name)
+
+    uncompressed_size = property(get_uncompressed_size)
+
+    compressed_size = property(get_compressed_size)
+
+    relative_offset = property(get_relative_offset)
+
+
+def read_entries(archive):
+    offset = 0
+
+    version = struct.unpack_from('<26s26x', archive, offset)[0]
+
+    offset += 52
+
+    entry_count = struct.unpack_from('<I4x', archive, offset)[0]
+
+    offset += 8
+
+    entries = []
+
+    for x in range(entry_count):
+        entry = Entry(*struct.unpack_from('<60s3I', archive, offset))
+
+        entries.append(entry)
+
+        offset += 72
+
+    return version, entries, offset
+
+
+def compile_pattern(pattern):
+    # "re:" patterns are regular expressions, everything else is a glob that
+    # ignores case like the file names on the client
+    if pattern.startswith('re:'):
+        return re.compile(pattern[3:])
+
+    return re.compile(fnmatch.translate(pattern), re.IGNORECASE)
+
+
+def select_entries(entries, includes, excludes):
+    # keeps the entries matching any include (all of them when there is none)
+    # and no exclude, in table order
+    selected = []
+
+    for entry in entries:
+        if len(includes) > 0 and not any(include.match(entry.name) for include in includes):
+            continue
+
+        if any(exclude.match(entry.name) for exclude in excludes):
+            continue
+
+        selected.append(entry)
+
+    return selected
+
+
+# the escapes the 2.7 packer's minidom used in attribute values; newer
+# minidoms also escape tabs and line breaks, which would make crc.xml depend
+# on the python version
+CRC_ESCAPES = [('&', '&amp;'), ('<', '&lt;'), ('"', '&quot;'), ('>', '&gt;')]
+
+
+class CrcWriter(object):
+    # writes crc.xml one Item at a time to a binary file object, giving the
+    # same bytes as the 2.7 packer building it with minidom and calling
+    # toprettyxml(indent="    ")
+    def __init__(self, file_object):
+        self.__file_object = file_object
+        self.__count = 0
+
+        self.__file_object.write(b'<?xml version="1.0" ?>\n<FileInfo>\n    <Version>\n        <Item Name="V.0.2."/>\n    </Version>\n')
+
+    def add(self, name, size, checksum):
+        if self.__count <= 0:
+            self.__file_object.write(b'    <File>\n')
+
+        self.__count += 1
+
+        for character, escape in CRC_ESCAPES:
+            name = name.replace(character, escape)
+
+        # attributes are in the sorted order the old packer's minidom wrote
+        self.__file_object.write(b'        <Item CheckSum="%08x" Name="%s" Size="%d" Version="0"/>\n' % (checksum, encode_name(name), size))
+
+    def close(self):
+        self.__file_object.write(b'    </File>\n</FileInfo>\n' if self.__count > 0 else b'    <File/>\n</FileInfo>\n')
+
+
+class CompressedBuffer(object):
+    # binary file object that deflates whatever is written to it, so crc.xml
+    # is compressed while entries are still being packed
+    def __init__(self):
+        self.__compressor = zlib.compressobj()
+        self.__chunks = []
+        self.__size = 0
+
+    def write(self, data):
+        self.__size += len(data)
+
+        self.__chunks.append(self.__compressor.compress(data))
+
+    def get_size(self):
+        return self.__size
+
+    def getvalue(self):
+        self.__chunks.append(self.__compressor.flush())
+
+        return b''.join(self.__chunks)
+
+    size = property(get_size)
+
+
+def get_crc_name(name):
+    # names come out of the Latin-1 parse one character per byte, so they
+    # give back the bytes the writer put in and go through decode_name like
+    # the entry names. the writer never uses character references; those of
+    # other writers are taken as bytes up to U+00FF and kept as they are past
+    # it
+    if name is None:
+        return None
+
+    try:
+        return decode_name(name.encode('latin-1'))
+    except UnicodeEncodeError:
+        return name
+
+
+def get_crc_key(name):
+    # a name the way it comes back out of crc.xml: tabs and line breaks are
+    # written as they are, and the parser turns them into spaces
+    return re.sub('\r\n|[\r\n\t]', ' ', name)
+
+
+def iter_crc(chunks):
+    # yields the (Name, Size, CheckSum) of every File/Item of a crc.xml
+    # document fed as an iterable of bytes, without building the whole tree.
+    # crc.xml has the raw bytes of the names and no encoding declaration, so
+    # it is parsed as Latin-1, under which any bytes are well-formed
+    parser = XMLPullParser(('start', 'end'))
+
+    tags = []
+
+    def read_events():
+        for event, element in parser.read_events():
+            if event == 'start':
+                tags.append(element.tag)
+
+                continue
+
+            tags.pop()
+
+            if element.tag == 'Item' and tags[-1:] == ['File']:
+                yield get_crc_name(element.get('Name')), element.get('Size'), element.get('CheckSum')
+
+            if len(tags) <= 2:
+                element.clear()
+
+    for chunk in chunks:
+        parser.feed(str(chunk, 'latin-1'))
+
+        for item in read_events():
+            yield item
+
+    parser.close()
+
+    for item in read_events():
+        yield item
+
+
+def read_crc(crc_file_data):
+    # maps every File/Item name of a crc.xml document to its (Size, CheckSum)
+    return dict((name, (size, checksum)) for name, size, checksum in iter_crc([crc_file_data]))
+
+
+class EntryFile(object):
+    def __init__(self, chunks):
+        self.__chunks = chunks
+        self.__buffer = b''
+
+    def read(self, size=-1):
+        if self.__chunks is None:
+            raise ValueError('I/O operation on closed file')
+
+        if size is None or size < 0:
+            data = self.__buffer + b''.join(self.__chunks)
+
+            self.__buffer = b''
+
+            return data
+
+        while len(self.__buffer) < size:
+            chunk = next(self.__chunks, None)
+
+            if chunk is None:
+                break
+
+            self.__buffer += chunk
+
+        data = self.__buffer[:size]
+
+        self.__buffer = self.__buffer[size:]
+
+        return data
+
+    def close(self):
+        self.__chunks = None
+        self.__buffer = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class KomArchive(object):
+    def __init__(self, source):
+        # source is the path of a .kom file or a bytes-like object holding one
+        self.__file_name = None
+        self.__file_object = None
+        self.__mmap = None
+        self.__data = None
+
+        try:
+            if isinstance(source, (str, os.PathLike)):
+                self.__file_name = os.fspath(source)
+                self.__file_object = open(self.__file_name, 'rb')
+                self.__mmap = mmap.mmap(self.__file_object.fileno(), 0, access=mmap.ACCESS_READ)
+
+                source = self.__mmap
+
+            # every slice of the archive is a view, nothing is copied until an
+            # entry is inflated
+            self.__data = memoryview(source).cast('B')
+
+            self.__version, self.__entries, self.__offset = read_entries(self.__data)
+        except:
+            self.close()
+
+            raise
+
+        # a later entry wins over an earlier one with the same name, the same
+        # way it overwrites it when everything is extracted to disk
+        self.__index = dict((entry.name, entry) for entry in self.__entries)
+
+    def get_file_name(self):
+        return self.__file_name
+
+    def get_version(self):
+        return self.__version
+
+    def get_entries(self):
+        return self.__entries
+
+    def get_offset(self):
+        return self.__offset
+
+    file_name = property(get_file_name)
+
+    version = property(get_version)
+
+    entries = property(get_entries)
+
+    offset = property(get_offset)
+
+    def __contains__(self, name):
+        return name in self.__index
+
+    def __iter__(self):
+        return iter(self.__entries)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def names(self):
+        return [entry.name for entry in self.__entries]
+
+    def get_entry(self, name):
+        return self.__index[name]
+
+    def read_crc(self):
+        if 'crc.xml' not in self:
+            return {}
+
+        # names are mapped back to the entry they were written for, so they
+        # match Entry.name
+        names = dict((get_crc_key(name), name) for name in self.__index)
+
+        return dict((names.get(name, name), (size, checksum)) for name, size, checksum in iter_crc(self.iter_entry(self.get_entry('crc.xml'))))
+
+    def get_compressed_view(self, entry):
+        start = self.__offset + entry.relative_offset
+
+        return self.__data[start:start + entry.compressed_size]
+
+    def get_compressed_data(self, entry):
+        return self.get_compressed_view(entry).tobytes()
+
+    def get_checksum(self, entry):
+        # CRC32 of the compressed entry as crc.xml stores it, computed over the
+        # archive without inflating anything
+        return "%08x" % (zlib.crc32(self.get_compressed_view(entry)) & 0xffffffff)
+
+    def verify(self, jobs=1):
+        # returns (problem, name, expected, found) tuples for entries whose
+        # CheckSum or Size disagree with crc.xml and for names missing on
+        # either side
+        checksums = self.read_crc()
+
+        entries = [entry for entry in self.__entries if entry.name != 'crc.xml']
+
+        # entries sharing their data are only checksummed once
+        shared_entries = {}
+
+        for entry in entries:
+            shared_entries.setdefault((entry.relative_offset, entry.compressed_size), entry)
+
+        if jobs > 1:
+            with ThreadPoolExecutor(jobs) as pool:
+                shared_checksums = dict(zip(shared_entries, pool.map(self.get_checksum, shared_entries.values())))
+        else:
+            shared_checksums = dict((key, self.get_checksum(entry)) for key, entry in shared_entries.items())
+
+        entry_checksums = [shared_checksums[(entry.relative_offset, entry.compressed_size)] for entry in entries]
+
+        problems = []
+
+        for entry, entry_checksum in zip(entries, entry_checksums):
+            if entry.name not in checksums:
+                problems.append(('missing', entry.name, None, entry_checksum))
+
+                continue
+
+            size, checksum = checksums[entry.name]
+
+            if checksum.lower() != entry_checksum:
+                problems.append(('checksum', entry.name, checksum, entry_checksum))
+
+            if size != str(entry.uncompressed_size):
+                problems.append(('size', entry.name, size, entry.uncompressed_size))
+
+        for name in checksums:
+            if name not in self:
+                problems.append(('unknown', name, checksums[name][1], None))
+
+        return problems
+
+    def is_stored(self, entry):
+        # entries whose compressed and uncompressed sizes are equal hold their
+        # data as is; a zlib stream that happens to be as long as its data (the
+        # only kind older packers wrote) is told apart by inflating it
+        if entry.compressed_size != entry.uncompressed_size:
+            return False
+
+        header = self.get_compressed_view(entry)[:2]
+
+        if len(header) < 2 or header[0] & 0x0f != 8 or (header[0] * 256 + header[1]) % 31 != 0:
+            return True
+
+        try:
+            return sum(len(chunk) for chunk in self.__iter_inflated(entry)) != entry.uncompressed_size
+        except zlib.error:
+            return True
+
+    def __iter_compressed(self, entry):
+        # the views are released as soon as they are consumed, or when the
+        # generator is closed, so none of them keeps the archive from closing
+        data = self.get_compressed_view(entry)
+
+        try:
+            for chunk_offset in range(0, len(data), CHUNK_SIZE):
+                chunk = data[chunk_offset:chunk_offset + CHUNK_SIZE]
+
+                try:
+                    yield chunk
+                finally:
+                    chunk.release()
+        finally:
+            data.release()
+
+    def __iter_inflated(self, entry):
+        decompressor = zlib.decompressobj()
+
+        compressed_chunks = self.__iter_compressed(entry)
+
+        try:
+            for data in compressed_chunks:
+                while data:
+                    chunk = decompressor.decompress(data, CHUNK_SIZE)
+
+                    if chunk:
+                        yield chunk
+
+                    data = decompressor.unconsumed_tail
+        finally:
+            compressed_chunks.close()
+
+        chunk = decompressor.flush()
+
+        if chunk:
+            yield chunk
+
+    def __iter_stored(self, entry):
+        compressed_chunks = self.__iter_compressed(entry)
+
+        try:
+            for chunk in compressed_chunks:
+                yield chunk.tobytes()
+        finally:
+            compressed_chunks.close()
+
+    def iter_entry(self, entry):
+        # inflates the entry in CHUNK_SIZE pieces straight from the archive, so
+        # memory use does not depend on the archive or entry size
+        if self.is_stored(entry):
+            return self.__iter_stored(entry)
+
+        return self.__iter_inflated(entry)
+
+    def open(self, name):
+        return EntryFile(self.iter_entry(self.get_entry(name)))
+
+    def read(self, name):
+        return b''.join(self.iter_entry(self.get_entry(name)))
+
+    def copy_entry(self, entry, file_object):
+        # stored entries go from the archive to the output file without being
+        # copied into python objects, with copy_file_range where there is one
+        # and sendfile otherwise. both only take some kinds of files on some
+        # systems (sendfile wants a socket on macOS and BSD), whatever they
+        # could not copy is written from the map
+        start = self.__offset + entry.relative_offset
+        size = entry.compressed_size
+
+        if self.__file_object is not None:
+            file_object.flush()
+
+            if hasattr(os, 'copy_file_range'):
+                start, size = self.__copy_range(os.copy_file_range, file_object, start, size)
+
+            if size > 0 and hasattr(os, 'sendfile'):
+                start, size = self.__copy_range(lambda in_fd, out_fd, count, offset: os.sendfile(out_fd, in_fd, offset, count), file_object, start, size)
+
+        if size > 0:
+            with self.__data[start:start + size] as data:
+                file_object.write(data)
+
+    def __copy_range(self, copy, file_object, start, size):
+        # copy(in_fd, out_fd, count, offset) in a loop, until it is done,
+        # copies nothing or fails
+        try:
+            while size > 0:
+                copied = copy(self.__file_object.fileno(), file_object.fileno(), size, start)
+
+                if copied <= 0:
+                    break
+
+                start += copied
+                size -= copied
+        except OSError:
+            pass
+
+        return start, size
+
+    def extract_entry(self, entry, file_name):
+        with open(file_name, 'wb') as file_object:
+            if self.is_stored(entry):
+                self.copy_entry(entry, file_object)
+            else:
+                for chunk in self.__iter_inflated(entry):
+                    file_object.write(chunk)
+
+    def extract(self, folder_name, jobs=1, entries=None):
+        if entries is None:
+            entries = self.__entries
+
+        # a later entry overwrites an earlier one with the same name, so only
+        # the last one is extracted
+        unique_entries = {}
+
+        for entry in entries:
+            unique_entries[entry.name] = entry
+
+        # entries sharing their data are inflated once and the file is copied.
+        # every file name is worked out first, so a name that cannot be
+        # written fails before anything is extracted
+        groups = {}
+
+        for entry in unique_entries.values():
+            groups.setdefault((entry.relative_offset, entry.compressed_size, entry.uncompressed_size), []).append((entry, get_file_name(folder_name, entry.name)))
+
+        if not os.path.exists(folder_name):
+            os.mkdir(folder_name)
+
+        def extract_group(group):
+            entry, file_name = group[0]
+
+            self.extract_entry(entry, file_name)
+
+            for copy_entry, copy_name in group[1:]:
+                shutil.copyfile(file_name, copy_name)
+
+        if jobs <= 1:
+            for group in groups.values():
+                extract_group(group)
+
+            return
+
+        # biggest entries first so a large one does not end up alone at the tail
+        groups = sorted(groups.values(), key=lambda group: group[0][0].compressed_size, reverse=True)
+
+        # zlib releases the GIL while inflating, so threads are enough here and
+        # they can all share the same archive
+        with ThreadPoolExecutor(jobs) as pool:
+            list(pool.map(extract_group, groups))
+
+    def close(self):
+        # views handed out by get_compressed_view() or held by unfinished
+        # iter_entry() generators can still be alive here; the map is then
+        # left to be unmapped when the last of them goes away, instead of
+        # raising over whatever exception is being handled
+        if self.__data is not None:
+            data = self.__data
+
+            self.__data = None
+
+            try:
+                data.release()
+            except BufferError:
+                pass
+
+        if self.__mmap is not None:
+            try:
+                self.__mmap.close()
+            except BufferError:
+                pass
+
+            self.__mmap = None
+
+        if self.__file_object is not None:
+            self.__file_object.close()
+
+            self.__file_object = None
+
+
+class PreviousArchive(KomArchive):
+    def __init__(self, file_name):
+        KomArchive.__init__(self, file_name)
+
+        self.__mtime = os.path.getmtime(file_name)
+
+        # without a readable crc.xml no entry can be trusted, so nothing is
+        # reused and every file is compressed again
+        try:
+            self.__checksums = self.read_crc()
+        except (zlib.error, ParseError):
+            self.__checksums = {}
+
+    def reuse_file(self, file_path, file_name):
+        # returns the old compressed entry when the file did not change, so it
+        # can be copied verbatim instead of being compressed again
+        if file_name not in self:
+            return None
+
+        entry = self.get_entry(file_name)
+
+        if os.path.getsize(file_path) != entry.uncompressed_size:
+            return None
+
+        compressed_file_data = self.get_compressed_data(entry)
+
+        file_data_crc32 = zlib.crc32(compressed_file_data) & 0xffffffff
+
+        # an entry that does not match its crc.xml CheckSum is never trusted
+        if self.__checksums.get(file_name, (None, None))[1] != "%08x" % file_data_crc32:
+            return None
+
+        # files modified after the previous archive was written are compared by
+        # content, which only costs an inflate instead of a compression
+        if os.path.getmtime(file_path) >= self.__mtime:
+            try:
+                with open(file_path, 'rb') as file_object:
+                    file_data = file_object.read()
+            except IOError:
+                return None
+
+            try:
+                if b''.join(self.iter_entry(entry)) != file_data:
+                    return None
+            except zlib.error:
+                return None
+
+        return entry.uncompressed_size, compressed_file_data, file_data_crc32
+
+
+class EntryCache(object):
+    # LRU cache of inflated entries keyed by (archive path, mtime, entry name)
+    # and bounded by the total size of the cached data. a rewritten archive
+    # gets a new mtime, so its old entries are never returned and just age out
+    def __init__(self, max_size=64 * 1024 * 1024):
+        self.__max_size = max_size
+        self.__entries = collections.OrderedDict()
+        self.__size = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__lock = threading.Lock()
+
+    def get_max_size(self):
+        return self.__max_size
+
+    def get_size(self):
+        return self.__size
+
+    def get_hits(self):
+        return self.__hits
+
+    def get_misses(self):
+        return self.__misses
+
+    def get_evictions(self):
+        return self.__evictions
+
+    max_size = property(get_max_size)
+
+    size = property(get_size)
+
+    hits = property(get_hits)
+
+    misses = property(get_misses)
+
+    evictions = property(get_evictions)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def read(self, archive_path, name):
+        archive_path = os.path.abspath(archive_path)
+
+        key = (archive_path, os.stat(archive_path).st_mtime_ns, name)
+
+        with self.__lock:
+            data = self.__entries.get(key)
+
+            if data is not None:
+                self.__entries.move_to_end(key)
+
+                self.__hits += 1
+
+                return data
+
+            self.__misses += 1
+
+        # the archive is inflated outside of the lock, so other threads are not
+        # held up by a miss
+        with KomArchive(archive_path) as archive:
+            data = archive.read(name)
+
+        self.__add(key, data)
+
+        return data
+
+    def __add(self, key, data):
+        # entries bigger than the whole cache are returned without being kept
+        if len(data) > self.__max_size:
+            return
+
+        with self.__lock:
+            if key in self.__entries:
+                return
+
+            self.__entries[key] = data
+
+            self.__size += len(data)
+
+            while self.__size > self.__max_size:
+                self.__size -= len(self.__entries.popitem(last=False)[1])
+
+                self.__evictions += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+            self.__size = 0
+
+
+def parse_policy(policy_string, policy=None):
+    # ".dds=0,.ogg=1,.p3m=9:filtered" -> {'.dds': (0, Z_DEFAULT_STRATEGY), ...}
+    # where "*" is the fallback for every other extension and "store" keeps
+    # the files of that extension uncompressed
+    if policy is None:
+        policy = {}
+
+    for rule in policy_string.split(','):
+        if rule.strip() == '':
+            continue
+
+        extension, setting = rule.split('=')
+
+        if ':' in setting:
+            level, strategy = setting.split(':')
+        else:
+            level, strategy = setting, 'default'
+
+        if level.strip() == 'store':
+            level = STORE
+        else:
+            level = int(level)
+
+            if level < -1 or level > 9:
+                raise ValueError('invalid compression level %d' % level)
+
+        extension = extension.strip().lower()
+
+        if extension != '*' and not extension.startswith('.'):
+            extension = '.' + extension
+
+        policy[extension] = (level, STRATEGIES[strategy.strip()])
+
+    return policy
+
+
+def get_policy(policy, file_name):
+    if policy is None:
+        return DEFAULT_POLICY
+
+    return policy.get(os.path.splitext(file_name)[1].lower(), policy.get('*', DEFAULT_POLICY))
+
+
+def compress_data(file_data, level=zlib.Z_DEFAULT_COMPRESSION, strategy=zlib.Z_DEFAULT_STRATEGY, store=False):
+    # returns the (uncompressed size, entry data, crc.xml CRC32) of one entry;
+    # stored entries are the ones whose compressed and uncompressed sizes are
+    # equal, so data that does not shrink is kept as is when store is set
+    if level is STORE:
+        compressed_file_data = file_data
+    else:
+        if level == zlib.Z_DEFAULT_COMPRESSION and strategy == zlib.Z_DEFAULT_STRATEGY:
+            compressed_file_data = zlib.compress(file_data)
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 8, strategy)
+
+            compressed_file_data = compressor.compress(file_data) + compressor.flush()
+
+        if store and len(compressed_file_data) >= len(file_data):
+            compressed_file_data = file_data
+
+    compressed_file_data = bytes(compressed_file_data)
+
+    return len(file_data), compressed_file_data, zlib.crc32(compressed_file_data) & 0xffffffff
+
+
+def compress_file(file_path, level=zlib.Z_DEFAULT_COMPRESSION, strategy=zlib.Z_DEFAULT_STRATEGY, store=False):
+    try:
+        with open(file_path, 'rb') as file_object:
+            file_data = file_object.read()
+    except IOError:
+        return None
+
+    try:
+        return compress_data(file_data, level, strategy, store)
+    except zlib.error:
+        return None
+
+
+def hash_file(file_path):
+    try:
+        with open(file_path, 'rb') as file_object:
+            file_hash = hashlib.sha256()
+
+            for chunk in iter(lambda: file_object.read(CHUNK_SIZE), b''):
+                file_hash.update(chunk)
+
+            return file_hash.digest()
+    except IOError:
+        return None
+
+
+def find_duplicates(file_names, get_size, get_digest, jobs=1):
+    # maps every name whose content equals the one of an earlier name in
+    # file_names to that earlier name; only files sharing their size with
+    # another one are hashed
+    file_sizes = dict((file_name, get_size(file_name)) for file_name in file_names)
+
+    size_counts = collections.Counter(file_sizes.values())
+
+    candidates = [file_name for file_name in file_names if size_counts[file_sizes[file_name]] > 1]
+
+    if jobs > 1:
+        with ThreadPoolExecutor(jobs) as pool:
+            digests = list(pool.map(get_digest, candidates))
+    else:
+        digests = [get_digest(file_name) for file_name in candidates]
+
+    first_names = {}
+    duplicates = {}
+
+    for file_name, digest in zip(candidates, digests):
+        if digest is None:
+            continue
+
+        key = (file_sizes[file_name], digest)
+
+        if key in first_names:
+            duplicates[file_name] = first_names[key]
+        else:
+            first_names[key] = file_name
+
+    return duplicates
+
+
+def ordered_map(pool, function, items, window):
+    # keeps at most window results in flight so memory stays bounded while the
+    # results are still handed back in the order of items
+    pending = collections.deque()
+
+    for item in items:
+        pending.append(pool.submit(function, item))
+
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def move_data(file_object, source, destination, size):
+    # only used to move data towards the start of the file, so copying front to
+    # back never overwrites bytes that were not read yet
+    while size > 0:
+        chunk_size = min(CHUNK_SIZE, size)
+
+        file_object.seek(source)
+
+        data = file_object.read(chunk_size)
+
+        file_object.seek(destination)
+        file_object.write(data)
+
+        source += chunk_size
+        destination += chunk_size
+        size -= chunk_size
+
+
+def write_archive(file_object, file_names, pack_file, jobs=1, duplicates=None):
+    # streams a whole archive into a seekable file object; pack_file(name)
+    # returns the compress_data() tuple of an entry or None to leave it out.
+    # names in duplicates get a table row pointing at the data of the earlier
+    # name they map to instead of data of their own.
+    # returns the number of entries written, crc.xml included
+    if duplicates is None:
+        duplicates = {}
+
+    shared_names = set(duplicates.values())
+
+    shared_entries = {}
+
+    crc_buffer = CompressedBuffer()
+
+    crc = CrcWriter(crc_buffer)
+
+    start = file_object.tell()
+
+    # the compressed data is streamed right after room reserved for the header
+    # and one table row per file plus crc.xml; the table is filled in at the end
+    data_offset = start + 60 + 72 * (len(file_names) + 1)
+
+    kom_file_entries = []
+
+    relative_offset = 0
+
+    file_object.seek(data_offset)
+
+    pool = None
+
+    packed_names = [file_name for file_name in file_names if file_name not in duplicates]
+
+    try:
+        if jobs > 1:
+            pool = ThreadPoolExecutor(jobs)
+
+            results = ordered_map(pool, pack_file, packed_names, jobs * 4)
+        else:
+            results = (pack_file(file_name) for file_name in packed_names)
+
+        for file_name in file_names:
+            if file_name in duplicates:
+                if duplicates[file_name] not in shared_entries:
+                    continue
+
+                file_size, compressed_size, file_data_crc32, entry_offset = shared_entries[duplicates[file_name]]
+
+                kom_file_entries.append(struct.pack('<60s3I', encode_name(file_name), file_size, compressed_size, entry_offset))
+
+                crc.add(file_name, file_size, file_data_crc32)
+
+                continue
+
+            result = next(results)
+
+            if result is None:
+                continue
+
+            file_size, compressed_file_data, file_data_crc32 = result
+
+            kom_file_entries.append(struct.pack('<60s3I', encode_name(file_name), file_size, len(compressed_file_data), relative_offset))
+
+            if file_name in shared_names:
+                shared_entries[file_name] = (file_size, len(compressed_file_data), file_data_crc32, relative_offset)
+
+            file_object.write(compressed_file_data)
+
+            relative_offset += len(compressed_file_data)
+
+            crc.add(file_name, file_size, file_data_crc32)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if len(kom_file_entries) <= 0 or relative_offset <= 0:
+        file_object.seek(start)
+        file_object.truncate()
+
+        return 0
+
+    crc.close()
+
+    crc_compressed_file_data = crc_buffer.getvalue()
+
+    kom_file_entries.append(struct.pack('<60s3I', b"crc.xml", crc_buffer.size, len(crc_compressed_file_data), relative_offset))
+
+    file_object.write(crc_compressed_file_data)
+
+    relative_offset += len(crc_compressed_file_data)
+
+    # files that could not be read or compressed leave unused table rows
+    # behind, so the data is moved down to sit right after the table
+    kom_data_offset = start + 60 + 72 * len(kom_file_entries)
+
+    if kom_data_offset < data_offset:
+        move_data(file_object, data_offset, kom_data_offset, relative_offset)
+
+        file_object.truncate(kom_data_offset + relative_offset)
+
+    kom_header = HEADER
+    kom_header += struct.pack('<25x')
+    kom_header += struct.pack('<2I', len(kom_file_entries), 1)
+
+    file_object.seek(start)
+    file_object.write(kom_header)
+    file_object.write(b''.join(kom_file_entries))
+    file_object.seek(kom_data_offset + relative_offset)
+
+    return len(kom_file_entries)
+
+
+def list_files(in_path):
+    # the files of a folder that go into an archive, in os.listdir order
+    file_names = []
+
+    if os.path.isdir(in_path) == True:
+        for file_name in os.listdir(in_path):
+            if file_name == 'crc.xml':
+                continue
+
+            file_path = os.path.join(in_path, file_name)
+
+            if os.path.isfile(file_path):
+                if len(encode_name(file_name)) > 60:
+                    continue
+
+                file_size = os.path.getsize(file_path)
+
+                if file_size <= 0:
+                    continue
+
+                file_names.append(file_name)
+
+    return file_names
+
+
+def pack(in_path, out_path, jobs=1, previous_path=None, policy=None, store=False, dedup=False):
+    # packs the files of in_path into out_path and returns the number of
+    # entries; previous_path enables reusing unchanged entries of an old archive
+    # and dedup makes files with the same content share their data
+    file_names = list_files(in_path)
+
+    if len(file_names) <= 0:
+        return 0
+
+    duplicates = None
+
+    if dedup:
+        duplicates = find_duplicates(file_names, lambda file_name: os.path.getsize(os.path.join(in_path, file_name)), lambda file_name: hash_file(os.path.join(in_path, file_name)), jobs)
+
+    previous = None
+
+    # the archive is written to a temporary file that only replaces out_path
+    # once it has entries, so an existing archive is left alone when nothing
+    # could be packed, and repacking over the previous archive works while it
+    # is still mapped
+    pack_path = out_path + '.tmp'
+
+    def pack_file(file_name):
+        file_path = os.path.join(in_path, file_name)
+
+        if previous is not None:
+            result = previous.reuse_file(file_path, file_name)
+
+            if result is not None:
+                return result
+
+        level, strategy = get_policy(policy, file_name)
+
+        return compress_file(file_path, level, strategy, store)
+
+    entry_count = 0
+
+    try:
+        try:
+            if previous_path is not None:
+                previous = PreviousArchive(previous_path)
+
+            with open(pack_path, 'w+b') as file_object:
+                entry_count = write_archive(file_object, file_names, pack_file, jobs, duplicates)
+        finally:
+            if previous is not None:
+                previous.close()
+
+                previous = None
+
+        if entry_count > 0:
+            os.replace(pack_path, out_path)
+    finally:
+        if os.path.exists(pack_path):
+            os.remove(pack_path)
+
+    return entry_count
+
+
+def pack_bytes(files, jobs=1, policy=None, store=False, dedup=False):
+    # builds an archive in memory from (name, bytes-like) pairs
+    files = [(name, data) for name, data in files if len(data) > 0 and len(encode_name(name)) <= 60 and name != 'crc.xml']
+
+    file_data = dict(files)
+
+    def pack_file(file_name):
+        level, strategy = get_policy(policy, file_name)
+
+        try:
+            return compress_data(file_data[file_name], level, strategy, store)
+        except zlib.error:
+            return None
+
+    file_names = [name for name, data in files]
+
+    duplicates = None
+
+    if dedup:
+        duplicates = find_duplicates(file_names, lambda file_name: len(file_data[file_name]), lambda file_name: hashlib.sha256(file_data[file_name]).digest(), jobs)
+
+    file_object = io.BytesIO()
+
+    write_archive(file_object, file_names, pack_file, jobs, duplicates)
+
+    return file_object.getvalue()
+
+
+def unpack(source, folder_name, jobs=1, includes=(), excludes=()):
+    with KomArchive(source) as archive:
+        archive.extract(folder_name, jobs, select_entries(archive.entries, includes, excludes))
+
+
+def list_entries(source, includes=(), excludes=()):
+    with KomArchive(source) as archive:
+        return select_entries(archive.entries, includes, excludes)
+
+
+def verify(source, jobs=1):
+    with KomArchive(source) as archive:
+        return archive.verify(jobs)
+
+
+def default_folder_name(file_name):
+    # the folder kom_unpacker.py extracts an archive into
+    return ntpath.basename(file_name).split('.')[0]
+
+
+def read_manifest(lines, default_action):
+    # one job per line: "[action] arguments", tab separated when the line has
+    # a tab and whitespace separated otherwise; blank lines and lines starting
+    # with # are skipped. pack takes an input folder and an output file, unpack
+    # an archive and an optional folder and verify an archive
+    jobs = []
+
+    for line in lines:
+        line = line.strip()
+
+        if line == '' or line.startswith('#'):
+            continue
+
+        fields = line.split('\t') if '\t' in line else line.split()
+
+        if fields[0] in ACTIONS:
+            action, fields = fields[0], fields[1:]
+        else:
+            action = default_action
+
+        if action == 'pack' and len(fields) == 2:
+            jobs.append(('pack', fields[0], fields[1]))
+        elif action == 'unpack' and len(fields) in (1, 2):
+            jobs.append(('unpack', fields[0], fields[1] if len(fields) > 1 else default_folder_name(fields[0])))
+        elif action == 'verify' and len(fields) == 1:
+            jobs.append(('verify', fields[0]))
+        else:
+            raise ValueError('invalid manifest line: %r' % line)
+
+    return jobs
+
+
+def get_job_size(job):
+    try:
+        if job[0] == 'pack':
+            return sum(os.path.getsize(os.path.join(job[1], file_name)) for file_name in list_files(job[1]))
+
+        return os.path.getsize(job[1])
+    except OSError:
+        return 0
+
+
+def run_job(job, options):
+    # returns (job, ok, seconds, message); options holds the policy, store and
+    # dedup settings for pack jobs and the includes and excludes for unpack jobs
+    start = time.perf_counter()
+
+    try:
+        if job[0] == 'pack':
+            entry_count = pack(job[1], job[2], 1, None, options.get('policy'), options.get('store', False), options.get('dedup', False))
+
+            ok, message = entry_count > 0, '%d entries' % entry_count
+        elif job[0] == 'unpack':
+            unpack(job[1], job[2], 1, options.get('includes', ()), options.get('excludes', ()))
+
+            ok, message = True, ''
+        else:
+            problems = verify(job[1])
+
+            ok, message = len(problems) <= 0, '%d problems' % len(problems)
+    except Exception as e:
+        ok, message = False, '%s: %s' % (type(e).__name__, e)
+
+    return job, ok, time.perf_counter() - start, message
+
+
+def get_job_waits(jobs):
+    # every job waits for the jobs before it in the manifest that use the same
+    # archive or folder, or one inside it, so a manifest can pack an archive
+    # and then verify or unpack it
+    paths = [[os.path.join(os.path.normcase(os.path.abspath(path)), '') for path in job[1:]] for job in jobs]
+
+    return [set(y for y in range(x) if any(path.startswith(other_path) or other_path.startswith(path) for path in paths[x] for other_path in paths[y])) for x in range(len(jobs))]
+
+
+def run_batch(jobs, workers=1, options=None):
+    # runs the jobs over a shared process pool and yields their run_job
+    # results as they finish; of the jobs not waiting for an earlier one, the
+    # biggest start first so the small ones fill in the gaps at the end
+    if options is None:
+        options = {}
+
+    sizes = [get_job_size(job) for job in jobs]
+    waits = get_job_waits(jobs)
+
+    pending = set(range(len(jobs)))
+
+    def take_ready():
+        ready = sorted((x for x in pending if len(waits[x]) <= 0), key=lambda x: sizes[x], reverse=True)
+
+        pending.difference_update(ready)
+
+        return ready
+
+    def finish(x):
+        for job_waits in waits:
+            job_waits.discard(x)
+
+    if workers <= 1:
+        while pending:
+            for x in take_ready():
+                yield run_job(jobs[x], options)
+
+                finish(x)
+
+        return
+
+    with ProcessPoolExecutor(workers) as pool:
+        running = {}
+
+        while pending or running:
+            for x in take_ready():
+                running[pool.submit(run_job, jobs[x], options)] = x
+
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                finish(running.pop(future))
+
+                yield future.result()
+
+
+def run_manifest(batch_path, default_action, workers, options):
+    # "-" reads the manifest from stdin; prints one status line per job as it
+    # finishes and returns how many of them failed. a manifest that cannot be
+    # read raises OSError or ValueError
+    if batch_path == '-':
+        batch = read_manifest(sys.stdin, default_action)
+    else:
+        with open(batch_path, 'r') as file_object:
+            batch = read_manifest(file_object, default_action)
+
+    failed = 0
+
+    for job, ok, seconds, message in run_batch(batch, workers, options):
+        print("%s\t%s\t%s\t%.3fs\t%s" % ('ok' if ok else 'failed', job[0], ' '.join(job[1:]), seconds, message))
+
+        sys.stdout.flush()
+
+        if not ok:
+            failed += 1
+
+    print("%d jobs, %d failed" % (len(batch), failed))
+
+    return failed
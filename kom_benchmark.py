@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+
+import getopt
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from xml.dom.minidom import Document, parseString
+
+from kom import CompressedBuffer, CrcWriter, KomArchive, encode_name, iter_crc, pack, parse_policy
+
+
+def benchmark_policy(in_path, out_path, policy, jobs, repeat):
+    # best of repeat runs for both directions
+    pack_times = []
+    unpack_times = []
+
+    for x in range(repeat):
+        start = time.perf_counter()
+
+        pack(in_path, out_path, jobs, None, policy)
+
+        pack_times.append(time.perf_counter() - start)
+
+        archive = KomArchive(out_path)
+
+        try:
+            start = time.perf_counter()
+
+            # inflates every entry without writing it, so the disk does not
+            # hide the difference between the policies
+            for entry in archive.entries:
+                for chunk in archive.iter_entry(entry):
+                    pass
+
+            unpack_times.append(time.perf_counter() - start)
+        finally:
+            archive.close()
+
+    return min(pack_times), os.path.getsize(out_path), min(unpack_times)
+
+
+def write_crc_minidom(items):
+    # how crc.xml used to be built
+    crc = Document()
+
+    crc_file_info = crc.createElement("FileInfo")
+
+    crc.appendChild(crc_file_info)
+
+    crc_file_info_version = crc.createElement("Version")
+
+    crc_file_info.appendChild(crc_file_info_version)
+
+    crc_file_info_version_item = crc.createElement("Item")
+
+    crc_file_info_version_item.setAttribute("Name", "V.0.2.")
+
+    crc_file_info_version.appendChild(crc_file_info_version_item)
+
+    crc_file_info_file = crc.createElement("File")
+
+    crc_file_info.appendChild(crc_file_info_file)
+
+    for name, size, checksum in items:
+        crc_file_info_file_item = crc.createElement("Item")
+
+        crc_file_info_file_item.setAttribute("CheckSum", "%08x" % checksum)
+        crc_file_info_file_item.setAttribute("Name", name)
+        crc_file_info_file_item.setAttribute("Size", str(size))
+        crc_file_info_file_item.setAttribute("Version", str(0))
+
+        crc_file_info_file.appendChild(crc_file_info_file_item)
+
+    crc_file_data = encode_name(crc.toprettyxml(indent="    "))
+
+    return len(crc_file_data), zlib.compress(crc_file_data)
+
+
+def write_crc_streaming(items):
+    crc_buffer = CompressedBuffer()
+
+    crc = CrcWriter(crc_buffer)
+
+    for name, size, checksum in items:
+        crc.add(name, size, checksum)
+
+    crc.close()
+
+    return crc_buffer.size, crc_buffer.getvalue()
+
+
+def read_crc_minidom(crc_file_data):
+    crc = parseString(crc_file_data)
+
+    return [(item.getAttribute('Name'), item.getAttribute('Size'), item.getAttribute('CheckSum')) for item in crc.getElementsByTagName('Item')[1:]]
+
+
+def read_crc_streaming(crc_file_data):
+    return list(iter_crc([crc_file_data]))
+
+
+def benchmark_crc(item_count, repeat):
+    # compares the minidom crc.xml writer and parser with the streaming ones
+    items = [("file_%06d.dds" % x, x * 37 + 1, zlib.crc32(b"%d" % x)) for x in range(item_count)]
+
+    if write_crc_minidom(items) != write_crc_streaming(items):
+        raise ValueError('the streaming crc.xml differs from the minidom one')
+
+    crc_file_data = zlib.decompress(write_crc_streaming(items)[1])
+
+    if read_crc_minidom(crc_file_data) != read_crc_streaming(crc_file_data):
+        raise ValueError('the streaming crc.xml parser differs from the minidom one')
+
+    print("%-40s %10s" % ("crc.xml (%d items)" % item_count, "time (s)"))
+
+    for name, function, argument in (("minidom write", write_crc_minidom, items), ("streaming write", write_crc_streaming, items), ("minidom parse", read_crc_minidom, crc_file_data), ("streaming parse", read_crc_streaming, crc_file_data)):
+        times = []
+
+        for x in range(repeat):
+            start = time.perf_counter()
+
+            function(argument)
+
+            times.append(time.perf_counter() - start)
+
+        print("%-40s %10.3f" % (name, min(times)))
+
+
+def main(argv):
+    if len(argv) < 2:
+        sys.exit(2)
+
+    try:
+        options, arguments = getopt.getopt(argv, 'i:j:r:', ['in=', 'jobs=', 'repeat=', 'policy=', 'crc='])
+    except getopt.GetoptError:
+        sys.exit(2)
+
+    in_path = None
+    jobs = 1
+    repeat = 3
+    policies = [('default', None)]
+    crc_item_count = None
+
+    try:
+        for option, argument in options:
+            if option in ('-i', '--in'):
+                in_path = argument
+            elif option in ('-j', '--jobs'):
+                jobs = int(argument)
+            elif option in ('-r', '--repeat'):
+                repeat = max(1, int(argument))
+            elif option == '--policy':
+                policies.append((argument, parse_policy(argument)))
+            elif option == '--crc':
+                crc_item_count = int(argument)
+    except (ValueError, KeyError):
+        sys.exit(2)
+
+    if crc_item_count is not None:
+        benchmark_crc(crc_item_count, repeat)
+
+        if in_path is None:
+            return
+
+    if in_path is None or os.path.isdir(in_path) == False:
+        sys.exit(2)
+
+    input_size = sum(os.path.getsize(os.path.join(in_path, file_name)) for file_name in os.listdir(in_path) if os.path.isfile(os.path.join(in_path, file_name)))
+
+    temp_folder = tempfile.mkdtemp()
+
+    try:
+        print("%-40s %10s %12s %8s %10s" % ("policy", "pack (s)", "size", "ratio", "unpack (s)"))
+
+        for name, policy in policies:
+            pack_time, size, unpack_time = benchmark_policy(in_path, os.path.join(temp_folder, 'benchmark.kom'), policy, jobs, repeat)
+
+            print("%-40s %10.3f %12d %8.3f %10.3f" % (name, pack_time, size, size / max(input_size, 1), unpack_time))
+    finally:
+        shutil.rmtree(temp_folder)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
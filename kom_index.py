@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+
+import getopt
+import os
+import sqlite3
+import struct
+import sys
+import zlib
+from xml.etree.ElementTree import ParseError
+
+from kom import KomArchive, encode_name
+
+# entry names are stored as their raw bytes since version 1; they were TEXT
+# before, which cannot hold the names that are not UTF-8
+INDEX_VERSION = 1
+
+
+def open_index(index_path):
+    connection = sqlite3.connect(index_path)
+
+    # the index only caches what is in the archives, so an older one is
+    # dropped and built again
+    if connection.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+        connection.execute('DROP TABLE IF EXISTS entries')
+        connection.execute('DROP TABLE IF EXISTS archives')
+        connection.execute('PRAGMA user_version = %d' % INDEX_VERSION)
+
+    connection.execute('CREATE TABLE IF NOT EXISTS archives (path TEXT PRIMARY KEY, mtime REAL, size INTEGER)')
+    connection.execute('CREATE TABLE IF NOT EXISTS entries (name BLOB, archive TEXT, offset INTEGER, uncompressed_size INTEGER, compressed_size INTEGER, checksum TEXT)')
+    connection.execute('CREATE INDEX IF NOT EXISTS entries_name ON entries (name)')
+    connection.execute('CREATE INDEX IF NOT EXISTS entries_archive ON entries (archive)')
+
+    return connection
+
+
+def scan_archive(archive_path):
+    # only the header, the entry table and crc.xml are read, the rest of the
+    # mapped archive is never touched
+    archive = KomArchive(archive_path)
+
+    try:
+        try:
+            checksums = archive.read_crc()
+        except (zlib.error, ParseError):
+            checksums = {}
+
+        rows = []
+
+        for entry in archive.entries:
+            checksum = checksums.get(entry.name, (None, None))[1]
+
+            rows.append((encode_name(entry.name), archive_path, archive.offset + entry.relative_offset, entry.uncompressed_size, entry.compressed_size, checksum))
+
+        return rows
+    finally:
+        archive.close()
+
+
+def update_archive(connection, archive_path, indexed_status):
+    status = (os.path.getmtime(archive_path), os.path.getsize(archive_path))
+
+    # archives that kept their mtime and size are not opened at all
+    if indexed_status == status:
+        return
+
+    connection.execute('DELETE FROM entries WHERE archive = ?', (archive_path,))
+    connection.execute('DELETE FROM archives WHERE path = ?', (archive_path,))
+
+    try:
+        rows = scan_archive(archive_path)
+    except (OSError, ValueError, struct.error):
+        return
+
+    connection.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)', rows)
+    connection.execute('INSERT INTO archives VALUES (?, ?, ?)', (archive_path,) + status)
+
+
+def update_index(connection, folder_name):
+    archive_paths = []
+
+    for root, folder_names, file_names in os.walk(folder_name):
+        for file_name in file_names:
+            if file_name.lower().endswith('.kom'):
+                archive_paths.append(os.path.abspath(os.path.join(root, file_name)))
+
+    indexed = dict((path, (mtime, size)) for path, mtime, size in connection.execute('SELECT path, mtime, size FROM archives'))
+
+    # only archives under the scanned folder can have disappeared, the index
+    # can hold other folders too
+    folder_prefix = os.path.join(os.path.abspath(folder_name), '')
+
+    with connection:
+        # one transaction for the whole scan, the savepoints below would
+        # each commit on their own otherwise
+        connection.execute('BEGIN')
+
+        for archive_path in set(path for path in indexed if path.startswith(folder_prefix)) - set(archive_paths):
+            connection.execute('DELETE FROM entries WHERE archive = ?', (archive_path,))
+            connection.execute('DELETE FROM archives WHERE path = ?', (archive_path,))
+
+        for archive_path in archive_paths:
+            # every archive is stored under its own savepoint, so one that
+            # cannot be stored (a path that is not valid Unicode, say) is
+            # left out without undoing the rest of the scan
+            connection.execute('SAVEPOINT archive')
+
+            try:
+                update_archive(connection, archive_path, indexed.get(archive_path))
+            except (OSError, ValueError, sqlite3.Error):
+                connection.execute('ROLLBACK TO archive')
+
+            connection.execute('RELEASE archive')
+
+
+def lookup(connection, name):
+    return connection.execute('SELECT archive, offset, uncompressed_size, compressed_size, checksum FROM entries WHERE name = ?', (encode_name(name),)).fetchall()
+
+
+def main(argv):
+    if len(argv) < 2:
+        sys.exit(2)
+
+    try:
+        options, arguments = getopt.getopt(argv, 'x:d:l:', ['index=', 'dir=', 'lookup='])
+    except getopt.GetoptError:
+        sys.exit(2)
+
+    index_path = None
+    folder_name = None
+    name = None
+
+    for option, argument in options:
+        if option in ('-x', '--index'):
+            index_path = argument
+        elif option in ('-d', '--dir'):
+            folder_name = argument
+        elif option in ('-l', '--lookup'):
+            name = argument
+
+    if index_path is None or (folder_name is None and name is None):
+        sys.exit(2)
+
+    if folder_name is not None and os.path.isdir(folder_name) == False:
+        sys.exit(2)
+
+    connection = open_index(index_path)
+
+    try:
+        if folder_name is not None:
+            update_index(connection, folder_name)
+
+        if name is not None:
+            rows = lookup(connection, name)
+
+            for archive_path, offset, uncompressed_size, compressed_size, checksum in rows:
+                print("%s\t%d\t%d\t%d\t%s" % (archive_path, offset, uncompressed_size, compressed_size, checksum))
+
+            if len(rows) <= 0:
+                sys.exit(1)
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 # Copyright (c) 2009-2012 AJ
 # 
@@ -22,39 +22,15 @@
 
 
 import getopt
+import ntpath
 import os
+import re
 import struct
 import sys
 import zlib
-import ntpath
+from xml.etree.ElementTree import ParseError
 
-
-class Entry(object):
-    def __init__(self, name, uncompressed_size, compressed_size, relative_offset):
-        self.__name = name[0:name.find('\0')]
-        self.__uncompressed_size = uncompressed_size
-        self.__compressed_size = compressed_size
-        self.__relative_offset = relative_offset
-    
-    def get_name(self):
-        return self.__name
-    
-    def get_uncompressed_size(self):
-        return self.__uncompressed_size
-    
-    def get_compressed_size(self):
-        return self.__compressed_size
-    
-    def get_relative_offset(self):
-        return self.__relative_offset
-    
-    name = property(get_name)
-    
-    uncompressed_size = property(get_uncompressed_size)
-    
-    compressed_size = property(get_compressed_size)
-    
-    relative_offset = property(get_relative_offset)
+from kom import KomArchive, compile_pattern, run_manifest, select_entries
 
 
 def main(argv):
@@ -62,78 +38,95 @@ def main(argv):
         sys.exit(2)
     
     try:
-        options, arguments = getopt.getopt(argv, 'vf:', ['verbose', 'file='])
+        options, arguments = getopt.getopt(argv, 'vf:j:b:', ['verbose', 'file=', 'jobs=', 'verify', 'list', 'include=', 'exclude=', 'batch='])
     except getopt.GetoptError:
         sys.exit(2)
     
     verbose = False
     file_name = None
+    jobs = 1
+    verify = False
+    list_entries = False
+    includes = []
+    excludes = []
+    batch_path = None
     
     for option, argument in options:
-        if option in ('v', '--verbose'):
+        if option in ('-v', '--verbose'):
             verbose = True
-        elif option in ('f', '--file'):
+        elif option in ('-f', '--file'):
             file_name = argument
+        elif option in ('-j', '--jobs'):
+            try:
+                jobs = int(argument)
+            except ValueError:
+                sys.exit(2)
+        elif option == '--verify':
+            verify = True
+        elif option == '--list':
+            list_entries = True
+        elif option == '--include':
+            try:
+                includes.append(compile_pattern(argument))
+            except re.error:
+                sys.exit(2)
+        elif option == '--exclude':
+            try:
+                excludes.append(compile_pattern(argument))
+            except re.error:
+                sys.exit(2)
+        elif option in ('-b', '--batch'):
+            batch_path = argument
+    
+    if batch_path is not None:
+        try:
+            failed = run_manifest(batch_path, 'verify' if verify else 'unpack', jobs, {'includes': includes, 'excludes': excludes})
+        except (OSError, ValueError):
+            sys.exit(2)
+        
+        sys.exit(1 if failed > 0 else 0)
     
     if file_name is None:
-        file_name = argv[0]
+        if len(arguments) < 1:
+            sys.exit(2)
+        
+        file_name = arguments[0]
     
     if os.path.isfile(file_name) == False:
         sys.exit(2)
 
     folder_name = ntpath.basename(file_name).split('.')[0]
-    file_object = None
-    file_data = None
+    archive = None
     
     try:
-        file_object = open(file_name, 'rb')
+        try:
+            archive = KomArchive(file_name)
+        except (OSError, ValueError, struct.error):
+            sys.exit(2)
         
-        if file_object is not None:
-            file_data = file_object.read()
+        if verify:
+            try:
+                problems = archive.verify(jobs)
+            except (zlib.error, ParseError):
+                sys.exit(2)
+            
+            for problem in problems:
+                print("%s\t%s\t%s\t%s" % problem)
+            
+            if len(problems) > 0:
+                sys.exit(1)
+        elif list_entries:
+            # only the entry table is read, no entry data is touched
+            for entry in select_entries(archive.entries, includes, excludes):
+                print("%s\t%d\t%d\t%d" % (entry.name, entry.uncompressed_size, entry.compressed_size, entry.relative_offset))
+        else:
+            archive.extract(folder_name, jobs, select_entries(archive.entries, includes, excludes))
     finally:
-        if file_object is not None:
-            file_object.close()
-
-            file_object = None
-    
-    offset = 0
-    
-    version = struct.unpack_from('<26s26x', file_data, offset)[0]
-    
-    offset += 52
-    
-    entry_count = struct.unpack_from('<I4x', file_data, offset)[0]
-    
-    offset += 8
-    
-    entries = []
-    
-    for x in xrange(entry_count):
-        entry = Entry(*struct.unpack_from('<60s3I', file_data, offset))
-        
-        entries.append(entry)
-        
-        offset += 72
-
-    if not os.path.exists(folder_name):
-        os.mkdir(folder_name)
-
-    for entry in entries:
-        entry_file_data = file_data[offset + entry.relative_offset:offset + entry.relative_offset + entry.compressed_size]
-        
-        entry_file_data = zlib.decompress(entry_file_data)
-        
-        try:
-            file_object = open(str(folder_name) + '/' + str(entry.name), 'wb')
+        if archive is not None:
+            archive.close()
             
-            if file_object is not None:
-                file_object.write(entry_file_data)
-        finally:
-            if file_object is not None:
-                file_object.close()
-                
-                file_object = None
+            archive = None
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
\ No newline at end of file
+    main(sys.argv[1:])
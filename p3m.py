@@ -0,0 +1,452 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+P3M parsing core shared by p3m_json.py and the Blender add-ons. It does not
+need bpy.
+
+A P3M file is a 27-byte version string, the bone position and bone angle
+counts ('<2B'), the bone position records (3f position, 10B child angles and 2
+padding bytes), the bone angle records (4f rotation, 10B child positions and 2
+padding bytes), the vertex and face counts ('<2H'), a 260-byte texture name,
+the faces ('<3H') and the vertex records (3f position, f weight, B bone, 3
+extra bytes, 3f normal and 2f uv). Child indexes of 255 are unused slots.
+
+Every section is decoded from one buffer. The interleaved records are split
+into one flat array per field with strided slices, so nothing is unpacked
+value by value. Writing does the same the other way around into one buffer.
+"""
+
+import array
+import struct
+import sys
+
+
+VERSION_SIZE = 27
+
+TEXTURE_NAME_SIZE = 260
+
+CHILD_COUNT = 10
+
+NO_CHILD = 255
+
+NO_BONE = 255
+
+BONE_POSITION_SIZE = 24
+
+BONE_ANGLE_SIZE = 28
+
+FACE_SIZE = 6
+
+VERTEX_SIZE = 40
+
+# what the Blender exporter writes for the fields it does not know about
+DEFAULT_VERSION = b"Perfect 3D Model (Ver 0.5)\0"
+
+DEFAULT_BONE_POSITION_PADDING = b'\xff\xff'
+
+DEFAULT_BONE_ANGLE = b'\xff' * 16
+
+DEFAULT_BONE_ANGLE_PADDING = b'\0\0'
+
+DEFAULT_VERTEX_EXTRA = b'\0\0\0'
+
+
+class Model(object):
+    # flat arrays, one per record field: bone_positions holds x, y, z of
+    # every bone position, faces holds a, b, c of every face and so on.
+    # children, bones, padding and extra bytes are kept as bytes
+    def __init__(self):
+        self.version = b''
+        self.bone_positions = array.array('f')
+        self.bone_position_children = b''
+        self.bone_position_padding = b''
+        self.bone_angles = array.array('f')
+        self.bone_angle_children = b''
+        self.bone_angle_padding = b''
+        self.texture_name = b''
+        self.faces = array.array('H')
+        self.vertex_positions = array.array('f')
+        self.vertex_weights = array.array('f')
+        self.vertex_bones = b''
+        self.vertex_extra = b''
+        self.vertex_normals = array.array('f')
+        self.vertex_uvs = array.array('f')
+        self.trailer = b''
+
+    def get_bone_position_count(self):
+        return len(self.bone_position_children) // CHILD_COUNT
+
+    def get_bone_angle_count(self):
+        return len(self.bone_angle_children) // CHILD_COUNT
+
+    def get_face_count(self):
+        return len(self.faces) // 3
+
+    def get_vertex_count(self):
+        return len(self.vertex_bones)
+
+    bone_position_count = property(get_bone_position_count)
+
+    bone_angle_count = property(get_bone_angle_count)
+
+    face_count = property(get_face_count)
+
+    vertex_count = property(get_vertex_count)
+
+    def get_bone_position_children(self, index):
+        return get_children(self.bone_position_children, index)
+
+    def get_bone_angle_children(self, index):
+        return get_children(self.bone_angle_children, index)
+
+
+def get_children(children, index):
+    return [child for child in children[index * CHILD_COUNT:(index + 1) * CHILD_COUNT] if child != NO_CHILD]
+
+
+def pack_children(children):
+    # the CHILD_COUNT bytes of a record, unused slots set to NO_CHILD
+    if len(children) > CHILD_COUNT:
+        raise ValueError('a P3M bone has more than %d children' % CHILD_COUNT)
+
+    return bytes(children) + bytes([NO_CHILD]) * (CHILD_COUNT - len(children))
+
+
+def to_array(typecode, data):
+    values = array.array(typecode)
+
+    values.frombytes(data)
+
+    # the file is little-endian
+    if sys.byteorder != 'little':
+        values.byteswap()
+
+    return values
+
+
+def read_field(records, record_size, offset, size):
+    # gathers one field of every record into contiguous bytes, with one strided
+    # slice per byte of the field
+    count = len(records) // record_size
+
+    field = bytearray(count * size)
+
+    for x in range(size):
+        field[x::size] = records[offset + x::record_size]
+
+    return bytes(field)
+
+
+def read_section(data, offset, size):
+    if offset + size > len(data):
+        raise ValueError('the P3M file is truncated')
+
+    return data[offset:offset + size], offset + size
+
+
+def read_model(data):
+    # data is the whole file as a bytes-like object; strided slices of bytes
+    # are much faster than the ones of a memoryview, so it is copied once
+    # unless it already is bytes
+    data = bytes(data)
+
+    model = Model()
+
+    version, offset = read_section(data, 0, VERSION_SIZE)
+
+    model.version = version
+
+    counts, offset = read_section(data, offset, 2)
+
+    bone_position_count, bone_angle_count = struct.unpack('<2B', counts)
+
+    records, offset = read_section(data, offset, bone_position_count * BONE_POSITION_SIZE)
+
+    model.bone_positions = to_array('f', read_field(records, BONE_POSITION_SIZE, 0, 12))
+    model.bone_position_children = read_field(records, BONE_POSITION_SIZE, 12, CHILD_COUNT)
+    model.bone_position_padding = read_field(records, BONE_POSITION_SIZE, 22, 2)
+
+    records, offset = read_section(data, offset, bone_angle_count * BONE_ANGLE_SIZE)
+
+    model.bone_angles = to_array('f', read_field(records, BONE_ANGLE_SIZE, 0, 16))
+    model.bone_angle_children = read_field(records, BONE_ANGLE_SIZE, 16, CHILD_COUNT)
+    model.bone_angle_padding = read_field(records, BONE_ANGLE_SIZE, 26, 2)
+
+    counts, offset = read_section(data, offset, 4)
+
+    vertex_count, face_count = struct.unpack('<2H', counts)
+
+    texture_name, offset = read_section(data, offset, TEXTURE_NAME_SIZE)
+
+    model.texture_name = texture_name
+
+    # faces are not interleaved with anything, so they are copied as they are
+    records, offset = read_section(data, offset, face_count * FACE_SIZE)
+
+    model.faces = to_array('H', records)
+
+    records, offset = read_section(data, offset, vertex_count * VERTEX_SIZE)
+
+    model.vertex_positions = to_array('f', read_field(records, VERTEX_SIZE, 0, 12))
+    model.vertex_weights = to_array('f', read_field(records, VERTEX_SIZE, 12, 4))
+    model.vertex_bones = read_field(records, VERTEX_SIZE, 16, 1)
+    model.vertex_extra = read_field(records, VERTEX_SIZE, 17, 3)
+    model.vertex_normals = to_array('f', read_field(records, VERTEX_SIZE, 20, 12))
+    model.vertex_uvs = to_array('f', read_field(records, VERTEX_SIZE, 32, 8))
+
+    model.trailer = data[offset:]
+
+    return model
+
+
+def load_model(file_path):
+    with open(file_path, 'rb') as file_object:
+        return read_model(file_object.read())
+
+
+def to_bytes(values):
+    # little-endian bytes of an array, or the bytes themselves
+    if isinstance(values, array.array) and sys.byteorder != 'little':
+        values = array.array(values.typecode, values)
+
+        values.byteswap()
+
+    return bytes(values)
+
+
+def get_field(values, count, size, default):
+    # fields left empty get the exporter's default for every record
+    data = to_bytes(values)
+
+    if len(data) == 0 and count > 0:
+        data = default * count
+
+    if len(data) != count * size:
+        raise ValueError('a P3M field does not have one value per record')
+
+    return data
+
+
+def write_field(data, offset, record_size, count, field_offset, size, field):
+    # scatters contiguous field bytes into the records, with one strided slice
+    # per byte of the field
+    start = offset + field_offset
+
+    for x in range(size):
+        data[start + x:offset + count * record_size:record_size] = field[x::size]
+
+
+def write_model(model):
+    # returns the whole file as bytes; the counts come from the children and
+    # vertex bones, fields left empty get the exporter's defaults
+    bone_position_count = model.bone_position_count
+    bone_angle_count = model.bone_angle_count
+    face_count = model.face_count
+    vertex_count = model.vertex_count
+
+    version = get_field(model.version, 1, VERSION_SIZE, DEFAULT_VERSION)
+    texture_name = get_field(model.texture_name, 1, TEXTURE_NAME_SIZE, b'\0' * TEXTURE_NAME_SIZE)
+
+    if len(model.faces) != face_count * 3:
+        raise ValueError('a P3M face does not have three indexes')
+
+    trailer = bytes(model.trailer)
+
+    data = bytearray(VERSION_SIZE + 2 + bone_position_count * BONE_POSITION_SIZE + bone_angle_count * BONE_ANGLE_SIZE + 4 + TEXTURE_NAME_SIZE + face_count * FACE_SIZE + vertex_count * VERTEX_SIZE + len(trailer))
+
+    data[0:VERSION_SIZE] = version
+
+    offset = VERSION_SIZE
+
+    struct.pack_into('<2B', data, offset, bone_position_count, bone_angle_count)
+
+    offset += 2
+
+    write_field(data, offset, BONE_POSITION_SIZE, bone_position_count, 0, 12, get_field(model.bone_positions, bone_position_count, 12, b''))
+    write_field(data, offset, BONE_POSITION_SIZE, bone_position_count, 12, CHILD_COUNT, get_field(model.bone_position_children, bone_position_count, CHILD_COUNT, b''))
+    write_field(data, offset, BONE_POSITION_SIZE, bone_position_count, 22, 2, get_field(model.bone_position_padding, bone_position_count, 2, DEFAULT_BONE_POSITION_PADDING))
+
+    offset += bone_position_count * BONE_POSITION_SIZE
+
+    write_field(data, offset, BONE_ANGLE_SIZE, bone_angle_count, 0, 16, get_field(model.bone_angles, bone_angle_count, 16, DEFAULT_BONE_ANGLE))
+    write_field(data, offset, BONE_ANGLE_SIZE, bone_angle_count, 16, CHILD_COUNT, get_field(model.bone_angle_children, bone_angle_count, CHILD_COUNT, b''))
+    write_field(data, offset, BONE_ANGLE_SIZE, bone_angle_count, 26, 2, get_field(model.bone_angle_padding, bone_angle_count, 2, DEFAULT_BONE_ANGLE_PADDING))
+
+    offset += bone_angle_count * BONE_ANGLE_SIZE
+
+    struct.pack_into('<2H', data, offset, vertex_count, face_count)
+
+    offset += 4
+
+    data[offset:offset + TEXTURE_NAME_SIZE] = texture_name
+
+    offset += TEXTURE_NAME_SIZE
+
+    data[offset:offset + face_count * FACE_SIZE] = to_bytes(model.faces)
+
+    offset += face_count * FACE_SIZE
+
+    write_field(data, offset, VERTEX_SIZE, vertex_count, 0, 12, get_field(model.vertex_positions, vertex_count, 12, b''))
+    write_field(data, offset, VERTEX_SIZE, vertex_count, 12, 4, get_field(model.vertex_weights, vertex_count, 4, b''))
+    write_field(data, offset, VERTEX_SIZE, vertex_count, 16, 1, get_field(model.vertex_bones, vertex_count, 1, b''))
+    write_field(data, offset, VERTEX_SIZE, vertex_count, 17, 3, get_field(model.vertex_extra, vertex_count, 3, DEFAULT_VERTEX_EXTRA))
+    write_field(data, offset, VERTEX_SIZE, vertex_count, 20, 12, get_field(model.vertex_normals, vertex_count, 12, b''))
+    write_field(data, offset, VERTEX_SIZE, vertex_count, 32, 8, get_field(model.vertex_uvs, vertex_count, 8, b''))
+
+    offset += vertex_count * VERTEX_SIZE
+
+    data[offset:] = trailer
+
+    return bytes(data)
+
+
+def save_model(model, file_path):
+    data = write_model(model)
+
+    with open(file_path, 'wb') as file_object:
+        file_object.write(data)
+
+
+def get_vertex_bone_indexes(model):
+    # bone of every vertex as an index into the bones, NO_BONE when it has none
+    bone_position_count = model.bone_position_count
+
+    return [index if index == NO_BONE else index - bone_position_count for index in model.vertex_bones]
+
+
+def get_absolute_positions(model, bone_indexes=None, bone_positions=None):
+    # vertex positions are stored relative to their bone position;
+    # bone_positions replaces the ones of the file, the importer passes the
+    # heads of its bones there
+    if bone_indexes is None:
+        bone_indexes = get_vertex_bone_indexes(model)
+
+    if bone_positions is None:
+        bone_positions = model.bone_positions
+
+    positions = model.vertex_positions.tolist()
+
+    for x, index in enumerate(bone_indexes):
+        if index != NO_BONE:
+            positions[x * 3] += bone_positions[index * 3]
+            positions[x * 3 + 1] += bone_positions[index * 3 + 1]
+            positions[x * 3 + 2] += bone_positions[index * 3 + 2]
+
+    return positions
+
+
+def get_flipped_uvs(model):
+    # u and 1 - v of every vertex, the way Blender and the viewers expect them
+    uvs = model.vertex_uvs.tolist()
+
+    uvs[1::2] = [1 - v for v in uvs[1::2]]
+
+    return uvs
+
+
+def get_mesh_faces(model):
+    # flat a, b, c of the faces a mesh can hold: faces using a vertex twice,
+    # pointing past the vertices or repeating an earlier face are left out,
+    # the same ones bmesh refuses
+    vertex_count = model.vertex_count
+    faces = model.faces
+
+    mesh_faces = []
+    seen = set()
+
+    for x in range(0, len(faces) - len(faces) % 3, 3):
+        face = faces[x:x + 3]
+        key = frozenset(face)
+
+        if len(key) != 3 or max(face) >= vertex_count or key in seen:
+            continue
+
+        seen.add(key)
+
+        mesh_faces.extend(face)
+
+    return mesh_faces
+
+
+def get_loop_uvs(faces, uvs):
+    # u, v of every face corner, from the flat faces and per-vertex uvs
+    loop_uvs = [0.0] * (len(faces) * 2)
+
+    loop_uvs[0::2] = [uvs[index * 2] for index in faces]
+    loop_uvs[1::2] = [uvs[index * 2 + 1] for index in faces]
+
+    return loop_uvs
+
+
+def get_weight_groups(bone_indexes, weights):
+    # vertex indexes grouped by (bone, weight), so every group is assigned with
+    # one call; vertices without a bone are left out
+    groups = {}
+
+    for x, index in enumerate(bone_indexes):
+        if index != NO_BONE:
+            groups.setdefault((index, weights[x]), []).append(x)
+
+    return groups
+
+
+def get_unused_bones(parents, used_bones):
+    # bones that neither influence a vertex nor have a descendant that does,
+    # given the parent index (or None) of every bone. every used bone marks its
+    # ancestors up to the first one already marked, so each bone is visited
+    # once
+    needed = set()
+
+    for index in used_bones:
+        while index is not None and index not in needed:
+            needed.add(index)
+
+            index = parents[index]
+
+    return [index for index in range(len(parents)) if index not in needed]
+
+
+def get_used_bones(bone_indexes, bone_count):
+    return set(index for index in bone_indexes if 0 <= index < bone_count)
+
+
+def get_parent_indexes(names, parent_names):
+    # index of the parent of every bone, -1 for the roots; parent_names holds
+    # the name of the parent of every bone, or None
+    indexes = dict((name, x) for x, name in enumerate(names))
+
+    return [indexes.get(parent_name, -1) if parent_name is not None else -1 for parent_name in parent_names]
+
+
+def get_dominant_groups(group_counts, groups, group_weights):
+    # the weight of the first group of every vertex (1 without groups) and its
+    # highest group as its bone (-1 without groups). groups and group_weights
+    # hold the groups of all the vertices one after another, group_counts how
+    # many of them belong to each vertex
+    weights = []
+    bones = []
+
+    offset = 0
+
+    for count in group_counts:
+        if count > 0:
+            weights.append(group_weights[offset])
+            bones.append(max(groups[offset:offset + count]))
+        else:
+            weights.append(1.0)
+            bones.append(-1)
+
+        offset += count
+
+    return weights, bones
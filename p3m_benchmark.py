@@ -0,0 +1,301 @@
+#!/usr/bin/python3
+
+import array
+import getopt
+import io
+import os
+import random
+import struct
+import sys
+import time
+
+from p3m import Model, get_absolute_positions, get_dominant_groups, get_flipped_uvs, get_loop_uvs, get_mesh_faces, get_parent_indexes, get_vertex_bone_indexes, get_weight_groups, pack_children, read_model, write_model
+
+
+def read_model_struct(data):
+    # how the P3M files used to be read, one field at a time
+    file_object = io.BytesIO(data)
+
+    file_object.read(27)
+
+    bone_position_count, bone_angle_count = struct.unpack('<2B', file_object.read(2))
+
+    bone_positions = []
+    for x in range(bone_position_count):
+        position = struct.unpack('<3f', file_object.read(3 * 4))
+        children = [struct.unpack('<1B', file_object.read(1))[0] for _ in range(10)]
+
+        bone_positions.append((position, children))
+
+        file_object.read(2)
+
+    bone_angles = []
+    for x in range(bone_angle_count):
+        file_object.read(4 * 4)
+
+        bone_angles.append([struct.unpack('<1B', file_object.read(1))[0] for _ in range(10)])
+
+        file_object.read(2)
+
+    vertex_count, face_count = struct.unpack('<2H', file_object.read(4))
+
+    file_object.read(260)
+
+    faces = [struct.unpack('<3H', file_object.read(3 * 2)) for x in range(face_count)]
+
+    vertices = [struct.unpack('<3f1f1B3x3f2f', file_object.read(40)) for x in range(vertex_count)]
+
+    return bone_positions, bone_angles, faces, vertices
+
+
+def build_mesh_arrays(data):
+    # everything the Blender importer computes before handing the arrays to
+    # foreach_set, with the bone positions of the file as bone heads
+    model = read_model(data)
+
+    bone_indexes = get_vertex_bone_indexes(model)
+    faces = get_mesh_faces(model)
+
+    return get_absolute_positions(model, bone_indexes), faces, get_loop_uvs(faces, get_flipped_uvs(model)), get_weight_groups(bone_indexes, model.vertex_weights)
+
+
+def get_parent_indexes_scan(names, parent_names):
+    # how the exporter used to find parents, scanning every bone for each bone
+    parent_indexes = []
+
+    for parent_name in parent_names:
+        parent_count = 0
+        parent_index = -1
+        for name in names:
+            if parent_name == name:
+                parent_index = parent_count
+                break
+            parent_count += 1
+
+        parent_indexes.append(parent_index)
+
+    return parent_indexes
+
+
+def get_vertex_bones_scan(vertex_groups, group_count):
+    # how the exporter used to find the bone of every vertex, scanning every
+    # vertex for each group
+    bones = [-1] * len(vertex_groups)
+
+    for group in range(group_count):
+        vs = [v for v in range(len(vertex_groups)) if group in [vg for vg, weight in vertex_groups[v]]]
+        for v in vs:
+            bones[v] = group
+
+    return bones
+
+
+def make_rig(bone_count, vertex_count):
+    # a random skeleton and vertices with one to four groups each
+    generator = random.Random(bone_count * 100003 + vertex_count)
+
+    names = ["bone_%d" % x for x in range(bone_count)]
+    parent_names = [None] + [names[generator.randrange(x)] for x in range(1, bone_count)]
+
+    vertex_groups = [[(generator.randrange(bone_count), generator.random()) for _ in range(generator.randint(1, 4))] for x in range(vertex_count)]
+
+    return names, parent_names, vertex_groups
+
+
+def benchmark_scaling(repeat):
+    # the old exporter scans against the indexes built once, at growing sizes
+    print("%-40s %10s %10s %14s" % ("bones / vertices", "scan (s)", "index (s)", "index (us/item)"))
+
+    for scale in (1, 2, 4, 8):
+        bone_count = 60 * scale
+        vertex_count = 2000 * scale
+
+        names, parent_names, vertex_groups = make_rig(bone_count, vertex_count)
+
+        group_counts = [len(groups) for groups in vertex_groups]
+        groups = [group for groups in vertex_groups for group, weight in groups]
+        group_weights = [weight for groups in vertex_groups for group, weight in groups]
+
+        if get_parent_indexes_scan(names, parent_names) != get_parent_indexes(names, parent_names):
+            raise ValueError('the parent index differs from the parent scan')
+
+        if get_vertex_bones_scan(vertex_groups, bone_count) != get_dominant_groups(group_counts, groups, group_weights)[1]:
+            raise ValueError('the dominant groups differ from the group scan')
+
+        times = []
+
+        for function in (lambda: (get_parent_indexes_scan(names, parent_names), get_vertex_bones_scan(vertex_groups, bone_count)), lambda: (get_parent_indexes(names, parent_names), get_dominant_groups(group_counts, groups, group_weights))):
+            function_times = []
+
+            for x in range(repeat):
+                start = time.perf_counter()
+
+                function()
+
+                function_times.append(time.perf_counter() - start)
+
+            times.append(min(function_times))
+
+        print("%-40s %10.4f %10.4f %14.3f" % ("%d / %d" % (bone_count, vertex_count), times[0], times[1], times[1] / (bone_count + vertex_count) * 1e6))
+
+
+def write_model_struct(model):
+    # how the exporter used to write its files, one write per field
+    file = io.BytesIO()
+
+    file.write("Perfect 3D Model (Ver 0.5)".encode("ascii") + b'\x00')
+
+    file.write(struct.pack('<B', model.bone_position_count))
+    file.write(struct.pack('<B', model.bone_angle_count))
+
+    for bone in range(model.bone_position_count):
+        for axis in range(3):
+            file.write(struct.pack('<f', model.bone_positions[bone * 3 + axis]))
+
+        for child in model.bone_position_children[bone * 10:bone * 10 + 10]:
+            file.write(struct.pack('<B', child))
+
+        file.write(b'\xff\xff')
+
+    for bone in range(model.bone_angle_count):
+        file.write(b'\xff\xff\xff\xff')
+        file.write(b'\xff\xff\xff\xff')
+        file.write(b'\xff\xff\xff\xff')
+        file.write(b'\xff\xff\xff\xff')
+
+        for child in model.bone_angle_children[bone * 10:bone * 10 + 10]:
+            file.write(struct.pack('<B', child))
+
+        file.write(struct.pack('<2x'))
+
+    file.write(struct.pack('<H', model.vertex_count))
+    file.write(struct.pack('<H', model.face_count))
+
+    file.write(struct.pack('<260x'))
+
+    for index in model.faces:
+        file.write(struct.pack('<H', index))
+
+    for x in range(model.vertex_count):
+        file.write(struct.pack('<3f', *model.vertex_positions[x * 3:x * 3 + 3]))
+        file.write(struct.pack('<f', model.vertex_weights[x]))
+        file.write(struct.pack('<B', model.vertex_bones[x]))
+        file.write(struct.pack('<3x'))
+        file.write(struct.pack('<3f', *model.vertex_normals[x * 3:x * 3 + 3]))
+        file.write(struct.pack('<2f', *model.vertex_uvs[x * 2:x * 2 + 2]))
+
+    return file.getvalue()
+
+
+def make_exported_model(model):
+    # the model as the exporter writes it, the fields it does not know about
+    # left to the writer's defaults
+    model.version = b''
+    model.bone_position_padding = b''
+    model.bone_angles = array.array('f')
+    model.bone_angle_padding = b''
+    model.texture_name = b''
+    model.vertex_extra = b''
+    model.trailer = b''
+
+    return model
+
+
+def make_model(vertex_count, bone_count=60):
+    # a random model with vertex_count vertices and as many faces
+    generator = random.Random(vertex_count)
+
+    model = Model()
+
+    model.bone_positions = array.array('f', [generator.uniform(-1, 1) for x in range(bone_count * 3)])
+    model.bone_position_children = b''.join(pack_children([x]) for x in range(bone_count))
+    model.bone_angle_children = b''.join(pack_children([x + 1] if x + 1 < bone_count else []) for x in range(bone_count))
+    model.faces = array.array('H', [generator.randrange(vertex_count) for x in range(vertex_count * 3)])
+    model.vertex_positions = array.array('f', [generator.uniform(-1, 1) for x in range(vertex_count * 3)])
+    model.vertex_weights = array.array('f', [generator.random() for x in range(vertex_count)])
+    model.vertex_bones = bytes(generator.randrange(bone_count) + bone_count for x in range(vertex_count))
+    model.vertex_normals = array.array('f', [generator.uniform(-1, 1) for x in range(vertex_count * 3)])
+    model.vertex_uvs = array.array('f', [generator.random() for x in range(vertex_count * 2)])
+
+    return make_exported_model(model)
+
+
+def benchmark_write(name, model, repeat):
+    data = write_model(model)
+
+    if write_model_struct(model) != data:
+        raise ValueError('p3m.write_model differs from the exporter\'s writes')
+
+    print("%-40s %10s %10s" % ("%s (%d vertices)" % (name, model.vertex_count), "time (s)", "MB/s"))
+
+    benchmark("struct write", write_model_struct, model, repeat, len(data))
+    benchmark("p3m.write_model", write_model, model, repeat, len(data))
+
+
+def copy_data(data):
+    # what parsing is compared to, a plain copy of the file
+    return bytearray(data)
+
+
+def benchmark(name, function, argument, repeat, size):
+    times = []
+
+    for x in range(repeat):
+        start = time.perf_counter()
+
+        function(argument)
+
+        times.append(time.perf_counter() - start)
+
+    print("%-40s %10.4f %10.1f" % (name, min(times), size / min(times) / (1024 * 1024)))
+
+
+def main(argv):
+    if len(argv) < 1:
+        sys.exit(2)
+
+    try:
+        options, arguments = getopt.getopt(argv, 'i:r:', ['in=', 'repeat=', 'scaling'])
+    except getopt.GetoptError:
+        sys.exit(2)
+
+    in_path = None
+    repeat = 10
+    scaling = False
+
+    try:
+        for option, argument in options:
+            if option in ('-i', '--in'):
+                in_path = argument
+            elif option in ('-r', '--repeat'):
+                repeat = max(1, int(argument))
+            elif option == '--scaling':
+                scaling = True
+    except ValueError:
+        sys.exit(2)
+
+    if scaling:
+        benchmark_scaling(repeat)
+
+        if in_path is None:
+            return
+
+    if in_path is None or os.path.isfile(in_path) == False:
+        sys.exit(2)
+
+    with open(in_path, 'rb') as file_object:
+        data = file_object.read()
+
+    print("%-40s %10s %10s" % (os.path.basename(in_path), "time (s)", "MB/s"))
+
+    benchmark("copy", copy_data, data, repeat, len(data))
+    benchmark("struct parse", read_model_struct, data, repeat, len(data))
+    benchmark("p3m.read_model", read_model, data, repeat, len(data))
+    benchmark("importer mesh arrays", build_mesh_arrays, data, repeat, len(data))
+
+    benchmark_write(os.path.basename(in_path), make_exported_model(read_model(data)), repeat)
+    benchmark_write("random", make_model(20000), repeat)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -22,23 +22,70 @@ bl_info = {
     "category": "Import-Export"
 }
 
+import array
 import os
-import struct
 import bpy
+import numpy as np
 from bpy.types import Operator
 from bpy_extras.io_utils import ExportHelper
 
+from p3m import CHILD_COUNT, Model, get_dominant_groups, get_parent_indexes, pack_children, save_model, to_array
+
+
+# swaps y and z and mirrors x, the way the game expects the axes
+AXIS_SWAP = np.array([[-1.0, 0.0, 0.0],
+                      [0.0, 0.0, 1.0],
+                      [0.0, 1.0, 0.0]], dtype=np.float32)
+
+
+def transform_points(matrix, points):
+    # matrix @ point for every row of points, the same way mathutils does it:
+    # every product in single precision, the sum in double precision starting
+    # from 0 and the result rounded to single precision
+    matrix = np.array(matrix, dtype=np.float32)
+
+    result = np.zeros((len(points), 3), dtype=np.float64)
+
+    for column in range(3):
+        result += (points[:, column:column + 1] * matrix[:3, column]).astype(np.float64)
+
+    result += matrix[:3, 3].astype(np.float64)
+
+    return result.astype(np.float32)
+
+
+def get_loop_indexes(polygons):
+    # loop indexes of all the polygons, polygon after polygon. foreach_get
+    # fills int properties from 32-bit buffers without converting them
+    loop_starts = np.zeros(len(polygons), dtype=np.int32)
+    loop_totals = np.zeros(len(polygons), dtype=np.int32)
+
+    polygons.foreach_get("loop_start", loop_starts)
+    polygons.foreach_get("loop_total", loop_totals)
+
+    offsets = np.cumsum(loop_totals) - loop_totals
+
+    return np.arange(loop_totals.sum()) - np.repeat(offsets, loop_totals) + np.repeat(loop_starts, loop_totals)
+
 
 def export_object(self, context):
     bones_position = []
     bones_children = []
-    faces = []
-    vertices = []
+    faces = np.zeros(0, dtype=np.int64)
+    positions = np.zeros((0, 3), dtype=np.float32)
+    normals = np.zeros((0, 3), dtype=np.float32)
+    weights = np.zeros(0, dtype=np.float32)
+    bones = np.zeros(0, dtype=np.int64)
+    uvs = np.zeros((0, 2), dtype=np.float32)
 
     for obj in bpy.data.objects:
         if obj.type == 'ARMATURE':
             print("---------- ARMATURE ----------")
             bone_count = 0
+
+            # parents are looked up by name in an index built once
+            parent_indexes = get_parent_indexes([bone.name for bone in obj.pose.bones], [bone.parent.name if bone.parent is not None else None for bone in obj.pose.bones])
+
             for bone in obj.pose.bones:
                 print("Exporting " + bone.name + "...")
 
@@ -58,13 +105,7 @@ def export_object(self, context):
                 bones_position.append(temp)
 
                 # Check if bone has parent
-                parent_count = 0
-                parent_index = -1
-                for b in obj.pose.bones:
-                    if bone.parent == b:
-                        parent_index = parent_count
-                        break
-                    parent_count += 1
+                parent_index = parent_indexes[bone_count]
 
                 bones_position[bone_count]['parent'] = parent_index
 
@@ -76,53 +117,88 @@ def export_object(self, context):
         elif obj.type == 'MESH':
             print("\n---------- MESH ----------")
             print("Exporting vertices...")
-            print(len(obj.data.vertices))
-            for vertex in obj.data.vertices:
-                v_pos = obj.matrix_world @ vertex.co
-                v_pos[0] = v_pos[0] * -1 if v_pos[0] != 0 else 0
 
-                v_nor = obj.matrix_world @ vertex.normal
-                v_nor[0] = v_nor[0] * -1 if v_nor[0] != 0 else 0
+            mesh = obj.data
+            vertex_count = len(mesh.vertices)
 
-                temp = {
-                    "weight": vertex.groups[0].weight if len(vertex.groups) > 0 else 1,
-                    "position": {"x": v_pos[0], "y": v_pos[2], "z": v_pos[1]},
-                    "normal": {"x": v_nor[0], "y": v_nor[2], "z": v_nor[1]},
-                    "texture": {"u": 0, "v": 0},
-                    "bone": 0
-                }
-                vertices.append(temp)
+            print(vertex_count)
+
+            # the world transform, axis swap and mirror are one matrix
+            matrix = np.array(obj.matrix_world, dtype=np.float32)
+            matrix[:3] = AXIS_SWAP @ matrix[:3]
+
+            mesh_positions = np.zeros(vertex_count * 3, dtype=np.float32)
+            mesh_normals = np.zeros(vertex_count * 3, dtype=np.float32)
+
+            mesh.vertices.foreach_get("co", mesh_positions)
+            mesh.vertices.foreach_get("normal", mesh_normals)
+
+            positions = np.concatenate((positions, transform_points(matrix, mesh_positions.reshape(-1, 3))))
+            normals = np.concatenate((normals, transform_points(matrix, mesh_normals.reshape(-1, 3))))
 
             print("Exporting faces...")
-            for loop in range(len(obj.data.loops)):
-                if loop % 3 == 0:
-                    if loop + 2 < len(obj.data.loops):
-                        face = {"a": obj.data.loops[loop].vertex_index, "b": obj.data.loops[loop + 1].vertex_index, "c": obj.data.loops[loop + 2].vertex_index}
-                        faces.append(face)
+
+            loop_vertices = np.zeros(len(mesh.loops), dtype=np.int32)
+
+            mesh.loops.foreach_get("vertex_index", loop_vertices)
+
+            faces = np.concatenate((faces, loop_vertices[:len(loop_vertices) // 3 * 3]))
 
             print("Exporting vertex groups...")
-            for group in obj.vertex_groups:
-                vs = [v for v in obj.data.vertices if group.index in [vg.group for vg in v.groups]]
-                for v in vs:
-                    vertices[v.index]['bone'] = group.index
+
+            # the groups of every vertex are read once, one vertex after another,
+            # and resolved to one weight and bone per vertex
+            group_counts = []
+            groups = []
+            group_weights = []
+
+            for vertex in mesh.vertices:
+                vertex_groups = vertex.groups
+
+                group_counts.append(len(vertex_groups))
+
+                for group in vertex_groups:
+                    groups.append(group.group)
+                    group_weights.append(group.weight)
+
+            mesh_weights, mesh_bones = get_dominant_groups(group_counts, groups, group_weights)
+
+            mesh_weights = np.array(mesh_weights, dtype=np.float32)
+            mesh_bones = np.array(mesh_bones, dtype=np.int64).reshape(-1)
+
+            # vertices without a group keep bone 0
+            grouped = mesh_bones >= 0
+
+            weights = np.concatenate((weights, mesh_weights))
+            bones = np.concatenate((bones, np.zeros(vertex_count, dtype=np.int64)))
+            uvs = np.concatenate((uvs, np.zeros((vertex_count, 2), dtype=np.float32)))
+
+            # vertex indexes of the mesh are used as they are, so a second mesh
+            # updates the first vertices
+            bones[:vertex_count][grouped] = mesh_bones[grouped]
 
             print("Exporting UVs...")
-            for face in obj.data.polygons:
-                for vert_idx, loop_idx in zip(face.vertices, face.loop_indices):
-                    uv_coords = obj.data.uv_layers.active.data[loop_idx].uv
-                    uv_coords.y = 1 - uv_coords.y
-                    vertices[vert_idx]["texture"] = {"u": uv_coords.x, "v": uv_coords.y}
 
-    # Put vertices to right location
-    for vertex in vertices:
-        if 'bone' in vertex:
-            bone = vertex['bone']
+            if mesh.uv_layers.active is not None:
+                loop_uvs = np.zeros(len(mesh.loops) * 2, dtype=np.float32)
+
+                mesh.uv_layers.active.data.foreach_get("uv", loop_uvs)
+
+                loop_uvs = loop_uvs.reshape(-1, 2)
+                loop_uvs[:, 1] = (1 - loop_uvs[:, 1].astype(np.float64)).astype(np.float32)
 
-            vertex['position']['x'] = vertex['position']['x'] - bones_position[bone]['head']['x']
-            vertex['position']['y'] = vertex['position']['y'] - bones_position[bone]['head']['y']
-            vertex['position']['z'] = vertex['position']['z'] - bones_position[bone]['head']['z']
+                # the last loop of a vertex gives its uv
+                loop_indexes = get_loop_indexes(mesh.polygons)[::-1]
 
-            vertex['position']['x'] = vertex['position']['x'] * -1 if vertex['position']['x'] != 0 else 0
+                vertex_indexes, first = np.unique(loop_vertices[loop_indexes], return_index=True)
+
+                uvs[vertex_indexes] = loop_uvs[loop_indexes[first]]
+
+    # Put vertices to right location
+    heads = np.array([[bone['head']['x'], bone['head']['y'], bone['head']['z']] for bone in bones_position], dtype=np.float64).reshape(-1, 3)
+
+    positions = positions.astype(np.float64) - heads[bones]
+    positions[:, 0] = np.where(positions[:, 0] != 0, -positions[:, 0], 0)
 
     # Put bones head to right location
     for bone in reversed(bones_position):
@@ -135,67 +211,37 @@ def export_object(self, context):
 
             bone['head']['x'] = bone['head']['x'] * -1 if bone['head']['x'] != 0 else 0
 
-    with open(self.filepath, 'wb') as file:
-        print("\n---------- WRITING TO FILE ----------")
-        file.write("Perfect 3D Model (Ver 0.5)".encode("ascii") + b'\x00')
-
-        print("Writing bones...")
-        file.write(struct.pack('<B', len(bones_position)))
-        file.write(struct.pack('<B', len(bones_children)))
-
-        for bone in range(len(bones_position)):
-            file.write(struct.pack('<f', bones_position[bone]['head']['x']))
-            file.write(struct.pack('<f', bones_position[bone]['head']['y']))
-            file.write(struct.pack('<f', bones_position[bone]['head']['z']))
-            file.write(struct.pack('<B', bones_position[bone]['children_angles']))
-
-            for _ in range(9):
-                file.write(b'\xff')
-
-            file.write(b'\xff\xff')  # add padding
-
-        for x in range(len(bones_children)):
-            file.write(b'\xff\xff\xff\xff')
-            file.write(b'\xff\xff\xff\xff')
-            file.write(b'\xff\xff\xff\xff')
-            file.write(b'\xff\xff\xff\xff')
-
-            for _ in range(10):
-                if _ < len(bones_children[x]):
-                    file.write(struct.pack('<B', bones_children[x][_]))
-                else:
-                    file.write(b'\xff')
-
-            file.write(struct.pack('<2x'))
-
-        print("Writing mesh...")
-        file.write(struct.pack('<H', len(vertices)))
-        file.write(struct.pack('<H', len(faces)))
-
-        file.write(struct.pack('<260x'))
-
-        print("Writing faces...")
-        for x in range(len(faces)):
-            file.write(struct.pack('<H', faces[x]['a']))
-            file.write(struct.pack('<H', faces[x]['b']))
-            file.write(struct.pack('<H', faces[x]['c']))
-
-        print("Writing vertices...")
-        for x in range(len(vertices)):
-            position = vertices[x]['position']
-            weight = vertices[x]['weight']
-            bone = vertices[x]['bone'] + len(bones_position)
-            normal = vertices[x]['normal']
-            texture = vertices[x]['texture']
-
-            file.write(struct.pack('<3f', position['x'], position['y'], position['z']))
-            file.write(struct.pack('<f', weight))
-            file.write(struct.pack('<B', bone))
-            file.write(struct.pack('<3x'))  # padding
-            file.write(struct.pack('<3f', normal['x'], normal['y'], normal['z']))
-            file.write(struct.pack('<2f', texture['u'], texture['v']))
-
-        file.close()
+    print("\n---------- WRITING TO FILE ----------")
+
+    # the version, padding, rotations, texture name and extra vertex bytes are
+    # left to the writer's defaults, which are what this exporter always wrote
+    model = Model()
+
+    print("Writing bones...")
+    model.bone_positions = array.array('f', [bone['head'][axis] for bone in bones_position for axis in "xyz"])
+    model.bone_position_children = b''.join(pack_children([bone['children_angles']]) for bone in bones_position)
+    model.bone_angle_children = b''.join(pack_children(children[:CHILD_COUNT]) for children in bones_children)
+
+    vertex_bones = bones + len(bones_position)
+
+    # the casts below would wrap around where struct.pack used to fail
+    if len(faces) > 0 and (faces.min() < 0 or faces.max() > 0xffff):
+        raise ValueError('a face index does not fit in a P3M file')
+
+    if len(vertex_bones) > 0 and (vertex_bones.min() < 0 or vertex_bones.max() > 0xff):
+        raise ValueError('a vertex bone does not fit in a P3M file')
+
+    print("Writing mesh...")
+    model.faces = to_array('H', faces.astype('<u2').tobytes())
+
+    print("Writing vertices...")
+    model.vertex_positions = positions.astype('<f4').tobytes()
+    model.vertex_weights = weights.astype('<f4').tobytes()
+    model.vertex_bones = vertex_bones.astype(np.uint8).tobytes()
+    model.vertex_normals = normals.astype('<f4').tobytes()
+    model.vertex_uvs = uvs.astype('<f4').tobytes()
+
+    save_model(model, self.filepath)
 
     return {'FINISHED'}
 
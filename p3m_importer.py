@@ -23,14 +23,14 @@ bl_info = {
 }
 
 import os
-import struct
-import bmesh
 import bpy
 import mathutils
 from bpy.props import (BoolProperty, CollectionProperty, StringProperty)
 from bpy.types import Operator, OperatorFileListElement
 from bpy_extras.io_utils import ImportHelper
 
+from p3m import get_absolute_positions, get_flipped_uvs, get_loop_uvs, get_mesh_faces, get_unused_bones, get_used_bones, get_vertex_bone_indexes, get_weight_groups, load_model
+
 
 def import_p3m(context, filepath, hide_unused_bones):
     model_name = bpy.path.basename(filepath)
@@ -39,14 +39,12 @@ def import_p3m(context, filepath, hide_unused_bones):
 
     model_name = os.path.splitext(model_name)[0]
 
-    file_object = open(filepath, 'rb')
-
-    file_object.read(27)  # skips the version
+    model = load_model(filepath)
 
     print("Reading bones...")
 
-    data = file_object.read(2)
-    bone_position_count, bone_angle_count = struct.unpack('<2B', data)
+    bone_position_count = model.bone_position_count
+    bone_angle_count = model.bone_angle_count
 
     armature = bpy.data.armatures.new('Armature')
     armature_object = bpy.data.objects.new("%s_armature" % model_name, armature)
@@ -60,44 +58,23 @@ def import_p3m(context, filepath, hide_unused_bones):
     angle_to_pos = [None] * bone_angle_count
 
     for x in range(bone_position_count):
-        data = file_object.read(3 * 4)
-        px, py, pz = struct.unpack('<3f', data)
-
-        children_angles = []
+        px, py, pz = model.bone_positions[x * 3:x * 3 + 3]
 
-        for _ in range(10):
-            data = file_object.read(1)
-            angle_index, = struct.unpack('<1B', data)
+        children_angles = model.get_bone_position_children(x)
 
-            if angle_index != 255:
-                children_angles.append(angle_index)
-                angle_to_pos[angle_index] = (px, py, pz)
+        for angle_index in children_angles:
+            angle_to_pos[angle_index] = (px, py, pz)
 
         bone_positions[x] = ((px, py, pz), children_angles)
 
-        file_object.read(2)  # ignores the padding
-
     bone_angles = [None] * bone_angle_count
 
     for x in range(bone_angle_count):
-        file_object.read(4 * 4)
-
         joint = armature.edit_bones.new("bone_%d" % x)
         joint.head = mathutils.Vector(angle_to_pos[x])
         joint.tail = mathutils.Vector(angle_to_pos[x])
 
-        children_positions = []
-
-        for _ in range(10):
-            data = file_object.read(1)
-            position_index, = struct.unpack('<1B', data)
-
-            if position_index != 255:
-                children_positions.append(position_index)
-
-        bone_angles[x] = children_positions
-
-        file_object.read(2)  # ignores the padding
+        bone_angles[x] = model.get_bone_angle_children(x)
 
     for x in range(bone_angle_count):
         children_indexes = []
@@ -129,73 +106,40 @@ def import_p3m(context, filepath, hide_unused_bones):
 
     print("Reading mesh...")
 
-    data = file_object.read(4)
-    vertex_count, face_count = struct.unpack('<2H', data)
-
-    file_object.read(260)  # ignores the texture_filename
-
-    print("Reading faces...")
+    vertex_count = model.vertex_count
 
-    faces = []
+    # the vertices hang from the bone heads the armature ended up with
+    bone_heads = [axis for bone in armature.edit_bones for axis in bone.head]
 
-    for x in range(face_count):
-        data = file_object.read(3 * 2)
-        a, b, c = struct.unpack('<3H', data)
+    bone_indexes = get_vertex_bone_indexes(model)
+    positions = get_absolute_positions(model, bone_indexes, bone_heads)
 
-        faces.append((a, b, c))
+    print("Reading faces...")
 
-    print("Reading vertices...")
+    faces = get_mesh_faces(model)
+    face_count = len(faces) // 3
 
-    bm = bmesh.new()
     mesh = bpy.data.meshes.new("%s_mesh" % model_name)
 
-    vertices = []
-
-    for x in range(vertex_count):
-        data = file_object.read(40)
-        px, py, pz, weight, index, nx, ny, nz, tu, tv = struct.unpack('<3f1f1B3x3f2f', data)
-
-        if index != 255:
-            index = index - bone_position_count
-
-            px += armature.edit_bones[index].head[0]
-            py += armature.edit_bones[index].head[1]
-            pz += armature.edit_bones[index].head[2]
-
-        tv = 1 - tv
-
-        vertex = bm.verts.new((px, py, pz))
+    mesh.vertices.add(vertex_count)
+    mesh.vertices.foreach_set("co", positions)
 
-        vertex.normal = mathutils.Vector((nx, ny, nz))
-        vertex.normal_update()
+    mesh.loops.add(len(faces))
+    mesh.loops.foreach_set("vertex_index", faces)
 
-        vertices.append((index, weight, tu, tv))
+    mesh.polygons.add(face_count)
+    mesh.polygons.foreach_set("loop_start", list(range(0, len(faces), 3)))
 
-    bm.verts.ensure_lookup_table()
-    bm.verts.index_update()
+    # loop_total is worked out from loop_start since Blender 4.0
+    if not mesh.polygons.bl_rna.properties["loop_total"].is_readonly:
+        mesh.polygons.foreach_set("loop_total", [3] * face_count)
 
     print("Setting UV coordinates...")
 
-    uv_layer = bm.loops.layers.uv.verify()
+    uv_layer = mesh.uv_layers.new()
+    uv_layer.data.foreach_set("uv", get_loop_uvs(faces, get_flipped_uvs(model)))
 
-    for f in faces:
-        a = bm.verts[f[0]]
-        b = bm.verts[f[1]]
-        c = bm.verts[f[2]]
-
-        try:
-            face = bm.faces.new((a, b, c))
-        except:
-            pass
-
-        for vert, loop in zip(face.verts, face.loops):
-            tu = vertices[vert.index][2]
-            tv = vertices[vert.index][3]
-
-            loop[uv_layer].uv = (tu, tv)
-
-    bm.to_mesh(mesh)
-    bm.free()
+    mesh.update(calc_edges=True)
 
     mesh_object = bpy.data.objects.new("%s_mesh" % model_name, mesh)
 
@@ -204,36 +148,25 @@ def import_p3m(context, filepath, hide_unused_bones):
     for x in range(bone_angle_count):
         mesh_object.vertex_groups.new(name="bone_%d" % x)
 
-    for i, vertex in enumerate(vertices):
-        if index != 255:
-            index = vertex[0]
-            weight = vertex[1]
+    for (index, weight), vertex_indexes in get_weight_groups(bone_indexes, model.vertex_weights).items():
+        mesh_object.vertex_groups[index].add(vertex_indexes, weight, "REPLACE")
 
-            mesh_object.vertex_groups[index].add([i], weight, "REPLACE")
+    hidden_bones = []
 
     if hide_unused_bones:
         print("Hiding unused bones...")
 
-        for bone in armature.edit_bones:
-            if not bone.children:
-                for b in [bone, *bone.parent_recursive]:
-                    bone_group = int(b.name.split('_')[-1])
-
-                    # if all the bone's children are hidden and there are no vertices influenced by the bone
-                    if not False in [c.hide for c in b.children] and not any([v for v in mesh.vertices if bone_group in [g.group for g in v.groups]]):
-                        b.hide = True
-                    else:
-                        break
+        bone_names = [bone.name for bone in armature.edit_bones]
+        bone_numbers = dict((name, x) for x, name in enumerate(bone_names))
 
-        for x in range(len(armature.edit_bones)):
-            bone = armature.edit_bones[x]
+        parents = [bone_numbers[bone.parent.name] if bone.parent is not None else None for bone in armature.edit_bones]
 
-            if bone.hide:
-                bone.select = True
+        # a bone is hidden when no vertex of its own or of its descendants is
+        # influenced by it
+        hidden_bones = [bone_names[x] for x in get_unused_bones(parents, get_used_bones(bone_indexes, len(bone_names)))]
 
-                bpy.ops.object.mode_set(mode='POSE')
-                bpy.ops.pose.hide()
-                bpy.ops.object.mode_set(mode='EDIT')
+        for name in hidden_bones:
+            armature.edit_bones[name].hide = True
 
     # corrects orientation
     correct_orientation = mathutils.Matrix([[-1.0, 0.0, 0.0, 0.0],
@@ -246,6 +179,11 @@ def import_p3m(context, filepath, hide_unused_bones):
 
     bpy.ops.object.mode_set(mode='OBJECT')
 
+    # the pose mode visibility is kept on the bones, which are only up to date
+    # outside of the edit mode
+    for name in hidden_bones:
+        armature.bones[name].hide = True
+
     mesh_object.parent = armature_object
     modifier = mesh_object.modifiers.new(type='ARMATURE', name="Armature")
     modifier.object = armature_object
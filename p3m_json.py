@@ -1,147 +1,561 @@
+import array
+import base64
 import os
 import getopt
-import struct
+import itertools
 import json
+import struct
 import sys
+import time
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
 
+from kom import KomArchive, check_entry_name
+from p3m import NO_BONE, Model, get_absolute_positions, get_flipped_uvs, get_vertex_bone_indexes, load_model, pack_children, read_model, save_model, to_array, to_bytes
 
-def import_p3m(argv):
-    if len(argv) < 2:
-        sys.exit(2)
+
+BUFFER_TYPES = {
+    'f': 'float32',
+    'h': 'int16',
+    'H': 'uint16',
+}
+
+# keys of the "p3m" object and the Model fields they hold
+RAW_FIELDS = [
+    ("version", 'version'),
+    ("bone_rotations", 'bone_angles'),
+    ("bone_position_padding", 'bone_position_padding'),
+    ("bone_angle_padding", 'bone_angle_padding'),
+    ("texture_name", 'texture_name'),
+    ("vertex_extra", 'vertex_extra'),
+    ("trailer", 'trailer'),
+]
+
+
+def iter_list(values):
+    # encodes an iterator the way json.dumps encodes a list, a few hundred
+    # elements at a time
+    yield '['
+
+    separator = ''
+
+    while True:
+        chunk = [json.dumps(value) for value in itertools.islice(values, 512)]
+
+        if not chunk:
+            break
+
+        yield separator + ', '.join(chunk)
+
+        separator = ', '
+
+    yield ']'
+
+
+def iter_object(items):
+    # encodes (key, value) pairs the way json.dumps encodes a dict; iterator
+    # values are encoded as lists one element at a time, so the whole document
+    # never has to be in memory
+    yield '{'
+
+    for x, (key, value) in enumerate(items):
+        yield (', ' if x > 0 else '') + json.dumps(key) + ': '
+
+        if isinstance(value, Iterator):
+            yield from iter_list(value)
+        else:
+            yield json.dumps(value)
+
+    yield '}'
+
+
+def get_raw_fields(model):
+    # base64 of the fields the schema has no other place for, so the P3M file
+    # can be written back byte for byte from its JSON. only written with
+    # --exact, the trailer alone can be larger than the rest of the JSON.
+    # rotations are kept as raw bytes too, the exporter fills them with NaNs
+    # that JSON cannot hold
+    return dict((name, base64.b64encode(to_bytes(getattr(model, field))).decode('ascii')) for name, field in RAW_FIELDS)
+
+
+def iter_json(model, exact=False):
+    # the (key, value) pairs of the original schema, bones, vertices and faces
+    # being generated while they are written
+    positions = model.bone_positions
+
+    bone_positions = ([{"x": positions[x * 3], "y": positions[x * 3 + 1], "z": positions[x * 3 + 2]}, {"children_angles": model.get_bone_position_children(x)}] for x in range(model.bone_position_count))
+
+    bone_angles = (model.get_bone_angle_children(x) for x in range(model.bone_angle_count))
+
+    face_indexes = model.faces
+
+    faces = ({"a": face_indexes[x], "b": face_indexes[x + 1], "c": face_indexes[x + 2]} for x in range(0, model.face_count * 3, 3))
+
+    def iter_vertices():
+        # the absolute position and flipped v of each vertex are worked out
+        # as it is written, the same way get_absolute_positions and
+        # get_flipped_uvs do for the whole model, so no per-vertex list of
+        # the model is built
+        bone_positions = model.bone_positions
+        bone_position_count = model.bone_position_count
+        vertex_positions = model.vertex_positions
+        vertex_normals = model.vertex_normals
+        vertex_uvs = model.vertex_uvs
+        vertex_weights = model.vertex_weights
+
+        for x, index in enumerate(model.vertex_bones):
+            px, py, pz = vertex_positions[x * 3:x * 3 + 3]
+
+            if index != NO_BONE:
+                index -= bone_position_count
+
+                px += bone_positions[index * 3]
+                py += bone_positions[index * 3 + 1]
+                pz += bone_positions[index * 3 + 2]
+
+            nx, ny, nz = vertex_normals[x * 3:x * 3 + 3]
+            tu, tv = vertex_uvs[x * 2:x * 2 + 2]
+
+            yield {"index": index, "weight": vertex_weights[x], "position": {"x": px, "y": py, "z": pz}, "normal": {"x": nx, "y": ny, "z": nz}, "texture": {"u": tu, "v": 1 - tv}}
+
+    final_json = [
+        ("bone_position_count", model.bone_position_count),
+        ("bone_angle_count", model.bone_angle_count),
+        ("bone_positions", bone_positions),
+        ("bone_angles", bone_angles),
+        ("vertex_count", model.vertex_count),
+        ("vertices", iter_vertices()),
+        ("face_count", model.face_count),
+        ("faces", faces),
+    ]
+
+    if exact:
+        final_json.append(("p3m", get_raw_fields(model)))
+
+    return final_json
+
+
+def build_columns(model):
+    # one flat list per attribute instead of one dict per vertex
+    bone_indexes = get_vertex_bone_indexes(model)
+
+    return {
+        "bone_positions": ('f', model.bone_positions.tolist()),
+        "positions": ('f', get_absolute_positions(model, bone_indexes)),
+        "normals": ('f', model.vertex_normals.tolist()),
+        "uvs": ('f', get_flipped_uvs(model)),
+        "bone_index": ('h', bone_indexes),
+        "weights": ('f', model.vertex_weights.tolist()),
+        "indices": ('H', model.faces.tolist()),
+    }
+
+
+def iter_columnar_json(model, binary_path=None, exact=False, binary_name=None):
+    # with binary_path, the columns are written there as raw little-endian
+    # buffers and the JSON only says where each one starts; binary_name is the
+    # file name the JSON gives, when the buffers are moved there afterwards
+    final_json = [
+        ("bone_position_count", model.bone_position_count),
+        ("bone_angle_count", model.bone_angle_count),
+        ("bone_children_angles", [model.get_bone_position_children(x) for x in range(model.bone_position_count)]),
+        ("bone_angles", [model.get_bone_angle_children(x) for x in range(model.bone_angle_count)]),
+        ("vertex_count", model.vertex_count),
+        ("face_count", model.face_count),
+    ]
+
+    columns = build_columns(model)
+
+    if binary_path is None:
+        for name, (typecode, values) in columns.items():
+            final_json.append((name, iter(values)))
+
+        if exact:
+            final_json.append(("p3m", get_raw_fields(model)))
+
+        return final_json
+
+    buffers = {}
+
+    with open(binary_path, 'wb') as file_object:
+        offset = 0
+
+        for name, (typecode, values) in columns.items():
+            values = array.array(typecode, values)
+
+            if sys.byteorder != 'little':
+                values.byteswap()
+
+            data = values.tobytes()
+
+            # every buffer starts 4-byte aligned, so it can be viewed as a
+            # typed array in place
+            padding = -len(data) % 4
+
+            file_object.write(data + b'\0' * padding)
+
+            buffers[name] = {"type": BUFFER_TYPES[typecode], "offset": offset, "count": len(values)}
+
+            offset += len(data) + padding
+
+    final_json.append(("binary", os.path.basename(binary_path) if binary_name is None else binary_name))
+    final_json.append(("buffers", buffers))
+
+    if exact:
+        final_json.append(("p3m", get_raw_fields(model)))
+
+    return final_json
+
+
+def write_json(model, out_path, columnar=False, binary=False, exact=False):
+    # the outputs are written to temporary files that only replace them once
+    # the whole model was written, so a model that fails leaves nothing that
+    # looks newer than its source
+    paths = [out_path]
+
+    if binary:
+        paths.insert(0, os.path.splitext(out_path)[0] + '.bin')
 
     try:
-        options, arguments = getopt.getopt(argv, 'i:o:', ['in=', 'out='])
-    except getopt.GetoptError:
-        sys.exit(2)
+        if columnar:
+            final_json = iter_columnar_json(model, paths[0] + '.tmp' if binary else None, exact, os.path.basename(paths[0]))
+        else:
+            final_json = iter_json(model, exact)
 
-    in_path = None
-    out_path = None
+        with open(out_path + '.tmp', "w") as file:
+            for chunk in iter_object(final_json):
+                file.write(chunk)
 
-    for option, argument in options:
-        if option in ('i', '--in'):
-            in_path = argument
-        elif option in ('o', '--out'):
-            out_path = argument
+        for path in paths:
+            os.replace(path + '.tmp', path)
+    finally:
+        for path in paths:
+            if os.path.exists(path + '.tmp'):
+                os.remove(path + '.tmp')
 
-    if in_path is None or out_path is None:
-        sys.exit(2)
 
-    file_name = os.path.basename(in_path)
+def read_buffers(final_json, folder_name):
+    # the columns of a --binary JSON, read back from its sidecar
+    with open(os.path.join(folder_name, final_json["binary"]), 'rb') as file_object:
+        data = file_object.read()
 
-    print("[Importing %s]" % file_name)
+    typecodes = dict((name, typecode) for typecode, name in BUFFER_TYPES.items())
 
-    model_name = os.path.splitext(file_name)[0]
+    columns = {}
 
-    file_object = open(in_path, 'rb')
+    for name, buffer in final_json["buffers"].items():
+        values = array.array(typecodes[buffer["type"]])
 
-    file_object.read(27)  # skips the version
+        values.frombytes(data[buffer["offset"]:buffer["offset"] + buffer["count"] * values.itemsize])
 
-    print("Reading bones...")
+        if sys.byteorder != 'little':
+            values.byteswap()
 
-    data = file_object.read(2)
-    bone_position_count, bone_angle_count = struct.unpack('<2B', data)
+        columns[name] = values.tolist()
 
-    print("Bone position count: " + str(bone_position_count))
-    print("Bone angle count: " + str(bone_angle_count))
+    return columns
 
-    bone_positions = [None] * bone_position_count
-    for x in range(bone_position_count):
-        data = file_object.read(3 * 4)
-        px, py, pz = struct.unpack('<3f', data)
-        children_angles = []
 
-        for _ in range(10):
-            data = file_object.read(1)
-            angle_index, = struct.unpack('<1B', data)
+def build_model(final_json, folder_name='.'):
+    # turns any of the JSON layouts back into a Model; folder_name is where a
+    # --binary sidecar is looked for
+    model = Model()
 
-            if angle_index != 255:
-                children_angles.append(angle_index)
+    if "vertices" in final_json:
+        bone_positions = [bone[0][axis] for bone in final_json["bone_positions"] for axis in "xyz"]
+        bone_position_children = [bone[1]["children_angles"] for bone in final_json["bone_positions"]]
 
-        bone_positions[x] = [{"x": px, "y": py, "z": pz}, {"children_angles": children_angles}]
+        vertices = final_json["vertices"]
 
-        file_object.read(2)  # ignores the padding
+        bone_indexes = [vertex["index"] for vertex in vertices]
+        positions = [vertex["position"][axis] for vertex in vertices for axis in "xyz"]
+        normals = [vertex["normal"][axis] for vertex in vertices for axis in "xyz"]
+        uvs = [vertex["texture"][axis] for vertex in vertices for axis in "uv"]
+        weights = [vertex["weight"] for vertex in vertices]
+        faces = [face[axis] for face in final_json["faces"] for axis in "abc"]
+    else:
+        columns = read_buffers(final_json, folder_name) if "buffers" in final_json else final_json
 
-    bone_angles = [None] * bone_angle_count
-    for x in range(bone_angle_count):
-        file_object.read(4 * 4)
+        bone_positions = columns["bone_positions"]
+        bone_position_children = final_json["bone_children_angles"]
 
-        children_positions = []
+        bone_indexes = columns["bone_index"]
+        positions = columns["positions"]
+        normals = columns["normals"]
+        uvs = columns["uvs"]
+        weights = columns["weights"]
+        faces = columns["indices"]
 
-        for _ in range(10):
-            data = file_object.read(1)
-            position_index, = struct.unpack('<1B', data)
+    bone_position_count = len(bone_position_children)
 
-            if position_index != 255:
-                children_positions.append(position_index)
+    model.bone_positions = array.array('f', bone_positions)
+    model.bone_position_children = b''.join(pack_children(children) for children in bone_position_children)
+    model.bone_angle_children = b''.join(pack_children(children) for children in final_json["bone_angles"])
 
-        bone_angles[x] = children_positions
+    # undoes get_absolute_positions() and get_flipped_uvs()
+    positions = list(positions)
 
-        file_object.read(2)  # ignores the padding
+    for x, index in enumerate(bone_indexes):
+        if index != NO_BONE:
+            positions[x * 3] -= bone_positions[index * 3]
+            positions[x * 3 + 1] -= bone_positions[index * 3 + 1]
+            positions[x * 3 + 2] -= bone_positions[index * 3 + 2]
 
-    """
-    bone_angles_children = []
-    for x in range(bone_angle_count):
-        children_indexes = []
+    uvs = list(uvs)
 
-        for pos in bone_angles[x]:
-            for ang in bone_positions[pos][1]:
-                children_indexes.append(ang)
+    uvs[1::2] = [1 - v for v in uvs[1::2]]
 
-        bone_angles_children.append(children_indexes)
-    """
+    model.vertex_positions = array.array('f', positions)
+    model.vertex_weights = array.array('f', weights)
+    model.vertex_bones = bytes(index if index == NO_BONE else index + bone_position_count for index in bone_indexes)
+    model.vertex_normals = array.array('f', normals)
+    model.vertex_uvs = array.array('f', uvs)
+    model.faces = array.array('H', faces)
 
-    print("Reading mesh...")
+    # JSON written before the "p3m" object existed gets the exporter's defaults
+    raw_fields = final_json.get("p3m", {})
 
-    data = file_object.read(4)
-    vertex_count, face_count = struct.unpack('<2H', data)
+    for name, field in RAW_FIELDS:
+        if name in raw_fields:
+            data = base64.b64decode(raw_fields[name])
 
-    file_object.read(260)  # ignores the texture_filename
+            setattr(model, field, to_array('f', data) if field == 'bone_angles' else data)
 
-    print("Reading faces...")
+    return model
 
-    faces = []
 
-    for x in range(face_count):
-        data = file_object.read(3 * 2)
-        a, b, c = struct.unpack('<3H', data)
+def export_p3m(in_path, out_path):
+    with open(in_path, 'r') as file:
+        final_json = json.load(file)
 
-        faces.append({"a": a, "b": b, "c": c})
+    save_model(build_model(final_json, os.path.dirname(in_path)), out_path)
 
-    print("Reading vertices...")
 
-    vertices = []
-    for x in range(vertex_count):
-        data = file_object.read(40)
-        px, py, pz, weight, index, nx, ny, nz, tu, tv = struct.unpack('<3f1f1B3x3f2f', data)
+def list_models(folder_name, recursive=False, read_archives=False):
+    # returns (source path, entry name, output name) of every model under
+    # folder_name; entry name is None for .p3m files and the name of the entry
+    # for models read from .kom archives, which go to a folder named after the
+    # archive
+    models = []
 
-        if index != 255:
-            index = index - bone_position_count
-            px += bone_positions[index][0]['x']
-            py += bone_positions[index][0]['y']
-            pz += bone_positions[index][0]['z']
+    for root, folder_names, file_names in os.walk(folder_name):
+        if not recursive:
+            folder_names[:] = []
 
-        tv = 1 - tv
+        folder_names.sort()
 
-        vertices.append({"index": index, "weight": weight, "position": {"x": px, "y": py, "z": pz}, "normal": {"x": nx, "y": ny, "z": nz}, "texture": {"u": tu, "v": tv}})
+        relative_root = os.path.relpath(root, folder_name)
 
-    print("Bulding JSON...")
+        for file_name in sorted(file_names):
+            source_path = os.path.join(root, file_name)
+            base_name, extension = os.path.splitext(file_name)
 
-    final_json = {
-        "bone_position_count": bone_position_count,
-        "bone_angle_count": bone_angle_count,
-        "bone_positions": bone_positions,
-        "bone_angles": bone_angles,
-        "vertex_count": vertex_count,
-        "vertices": vertices,
-        "face_count": face_count,
-        "faces": faces,
-    }
+            if extension.lower() == '.p3m':
+                models.append((source_path, None, os.path.normpath(os.path.join(relative_root, base_name + '.json'))))
+            elif extension.lower() == '.kom' and read_archives:
+                try:
+                    with KomArchive(source_path) as archive:
+                        entry_names = list(dict.fromkeys(archive.names()))
+                except (OSError, ValueError, struct.error):
+                    continue
+
+                for entry_name in entry_names:
+                    # entries named like paths would be written outside the
+                    # archive's folder, they are left out like kom refuses them
+                    try:
+                        check_entry_name(entry_name)
+                    except ValueError:
+                        continue
 
-    file = open(out_path, "w")
-    file.write(json.dumps(final_json))
-    file.close()
+                    if entry_name.lower().endswith('.p3m'):
+                        models.append((source_path, entry_name, os.path.normpath(os.path.join(relative_root, base_name, os.path.splitext(entry_name)[0] + '.json'))))
+
+    return models
+
+
+def is_up_to_date(source_path, out_path, binary=False):
+    paths = [out_path]
+
+    if binary:
+        paths.append(os.path.splitext(out_path)[0] + '.bin')
+
+    try:
+        source_mtime = os.path.getmtime(source_path)
+
+        return all(os.path.getmtime(path) >= source_mtime for path in paths)
+    except OSError:
+        return False
+
+
+# archive opened by the current worker; jobs come ordered by source, so
+# consecutive entries of the same archive do not reopen it
+open_archive = [None]
+
+
+def read_source(source_path, entry_name):
+    if entry_name is None:
+        with open(source_path, 'rb') as file_object:
+            return file_object.read()
+
+    if open_archive[0] is None or open_archive[0].file_name != source_path:
+        if open_archive[0] is not None:
+            open_archive[0].close()
+
+        open_archive[0] = None
+        open_archive[0] = KomArchive(source_path)
+
+    return open_archive[0].read(entry_name)
+
+
+def convert_job(job):
+    # returns (job, ok, size, message)
+    source_path, entry_name, out_path, columnar, binary, exact = job
+
+    try:
+        data = read_source(source_path, entry_name)
+
+        out_folder = os.path.dirname(out_path)
+
+        if out_folder:
+            os.makedirs(out_folder, exist_ok=True)
+
+        write_json(read_model(data), out_path, columnar, binary, exact)
+
+        return job, True, len(data), ''
+    except Exception as e:
+        # any error of a model, a bone index out of range included, only
+        # fails that model
+        return job, False, 0, "%s: %s" % (type(e).__name__, e)
+
+
+def convert_folder(folder_name, out_folder, jobs=1, recursive=False, read_archives=False, columnar=False, binary=False, exact=False):
+    start = time.perf_counter()
+
+    skipped = 0
+    convert_jobs = []
+
+    for source_path, entry_name, out_name in list_models(folder_name, recursive, read_archives):
+        out_path = os.path.join(out_folder, out_name)
+
+        if is_up_to_date(source_path, out_path, binary):
+            skipped += 1
+        else:
+            convert_jobs.append((source_path, entry_name, out_path, columnar, binary, exact))
+
+    converted = 0
+    failed = 0
+    size = 0
+
+    if jobs > 1:
+        pool = ProcessPoolExecutor(jobs)
+
+        results = pool.map(convert_job, convert_jobs, chunksize=16)
+    else:
+        pool = None
+
+        results = map(convert_job, convert_jobs)
+
+    try:
+        for job, ok, job_size, message in results:
+            if ok:
+                converted += 1
+                size += job_size
+            else:
+                failed += 1
+
+                print("failed\t%s\t%s" % (job[0] if job[1] is None else job[0] + ':' + job[1], message))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        elif open_archive[0] is not None:
+            open_archive[0].close()
+
+            open_archive[0] = None
+
+    seconds = time.perf_counter() - start
+
+    print("%d converted, %d skipped, %d failed, %.1f MB in %.3fs (%.1f models/s, %.1f MB/s)" % (converted, skipped, failed, size / (1024 * 1024), seconds, converted / max(seconds, 1e-9), size / (1024 * 1024) / max(seconds, 1e-9)))
+
+    return failed
+
+
+def import_p3m(argv):
+    if len(argv) < 2:
+        sys.exit(2)
+
+    try:
+        options, arguments = getopt.getopt(argv, 'i:o:cbxd:rkj:p', ['in=', 'out=', 'columnar', 'binary', 'exact', 'dir=', 'recursive', 'kom', 'jobs=', 'p3m'])
+    except getopt.GetoptError:
+        sys.exit(2)
+
+    in_path = None
+    out_path = None
+    columnar = False
+    binary = False
+    exact = False
+    folder_name = None
+    recursive = False
+    read_archives = False
+    jobs = 1
+    reverse = False
+
+    try:
+        for option, argument in options:
+            if option in ('-i', '--in'):
+                in_path = argument
+            elif option in ('-o', '--out'):
+                out_path = argument
+            elif option in ('-c', '--columnar'):
+                columnar = True
+            elif option in ('-b', '--binary'):
+                columnar = True
+                binary = True
+            elif option in ('-x', '--exact'):
+                exact = True
+            elif option in ('-d', '--dir'):
+                folder_name = argument
+            elif option in ('-r', '--recursive'):
+                recursive = True
+            elif option in ('-k', '--kom'):
+                read_archives = True
+            elif option in ('-j', '--jobs'):
+                jobs = int(argument)
+            elif option in ('-p', '--p3m'):
+                reverse = True
+    except ValueError:
+        sys.exit(2)
+
+    if folder_name is not None:
+        if out_path is None or os.path.isdir(folder_name) == False:
+            sys.exit(2)
+
+        if convert_folder(folder_name, out_path, jobs, recursive, read_archives, columnar, binary, exact) > 0:
+            sys.exit(1)
+
+        return
+
+    if in_path is None or out_path is None:
+        sys.exit(2)
+
+    file_name = os.path.basename(in_path)
+
+    if reverse:
+        print("[Exporting %s]" % file_name)
+
+        export_p3m(in_path, out_path)
+
+        return
+
+    print("[Importing %s]" % file_name)
+
+    model = load_model(in_path)
+
+    print("Bone position count: " + str(model.bone_position_count))
+    print("Bone angle count: " + str(model.bone_angle_count))
+
+    print("Bulding JSON...")
+
+    write_json(model, out_path, columnar, binary, exact)
 
 
 if __name__ == "__main__":
     import_p3m(sys.argv[1:])
-